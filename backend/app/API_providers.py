@@ -6,11 +6,14 @@ from io import BytesIO
 from PIL import Image, UnidentifiedImageError
 from flask import url_for
 from abc import ABC, abstractmethod
-import re
-import uuid
 from requests.exceptions import HTTPError
+from downloader import image_downloader
+from clip_client import register_image_key, CONTENT_KEY_HASH
+from blob_store import blob_store, BLOB_FOLDER
 
 
+IMAGE_EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp", "GIF": "gif"}
+
 AI_KEYWORDS = ["ai", "generated", "midjourney", "stable diffusion", "dall-e", "sora", "flux", "deepai"]
 
 def looks_like_ai(metadata):
@@ -22,24 +25,55 @@ def looks_like_ai(metadata):
     return any(k in text for k in AI_KEYWORDS)
 
 class APIProvider(ABC):
+    NAME = ""
     API_UPLOADS_FOLDER = ""
-    def __init__(self, api_key):
+    # How long keyword results from this provider may be served from cache, in seconds.
+    CACHE_TTL = 3600
+    CLIP_RENDITION = ""
+    def __init__(self, api_key, downloader=None, store=None):
         self.api_key = api_key
+        self.downloader = downloader or image_downloader
+        self.blob_store = store or blob_store
 
-    def saveImage(self, image_url, keyword, extension="jpg"):
-        os.makedirs(self.API_UPLOADS_FOLDER, exist_ok=True)
+    def source_key(self, image_id):
+        return f"{self.NAME}:{image_id}:{self.CLIP_RENDITION}"
 
-        response = requests.get(image_url, timeout=10)
-        response.raise_for_status()
+    def saveImage(self, image_url, image_id):
+        """Store an image in the blob store, downloading it only if this rendition was not stored before.
 
-        image = Image.open(BytesIO(response.content)).convert("RGB")
+        Returns the local path and the path relative to UPLOAD_FOLDER, which is what serve_image expects.
+        """
+        source_key = self.source_key(image_id)
+        local_path = self.blob_store.lookup(source_key)
 
-        safe_keyword = re.sub(r"[^a-zA-Z0-9_-]", "_", keyword.lower())
-        filename = f"{safe_keyword}_{uuid.uuid4().hex}.{extension}"
-        local_path = os.path.join(self.API_UPLOADS_FOLDER, filename)
-        
-        image.save(local_path)
-        return local_path, filename
+        if local_path is None:
+            response = self.downloader.get(image_url, timeout=10)
+            response.raise_for_status()
+            image_bytes = response.content
+
+            # Only the header is parsed here; the bytes are stored as downloaded, without re-encoding.
+            image_format = Image.open(BytesIO(image_bytes)).format
+            extension = IMAGE_EXTENSIONS.get(image_format, "jpg")
+            local_path = self.blob_store.put(source_key, image_bytes, extension)
+
+        # Blobs are named by their sha256, so the CLIP cache key is known without reading the file.
+        register_image_key(local_path, f"{CONTENT_KEY_HASH}:" + self.blob_store.content_hash(local_path))
+        return local_path, os.path.relpath(local_path, UPLOAD_FOLDER)
+
+    def saveImages(self, image_urls, image_ids):
+        """Download and save images in parallel. Failed downloads come back as None, in input order."""
+        results = self.downloader.map(lambda item: self.saveImage(*item), list(zip(image_urls, image_ids)))
+
+        saved = []
+        for image_url, result in zip(image_urls, results):
+            if isinstance(result, (requests.RequestException, OSError, UnidentifiedImageError)):
+                logging.warning(f"Failed to fetch {image_url}: {result}")
+                saved.append(None)
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                saved.append(result)
+        return saved
 
     @abstractmethod
     def fetch(self, keyword, num_images, blocked_urls):
@@ -47,19 +81,27 @@ class APIProvider(ABC):
 
 
 class PixabayProvider(APIProvider):
+    NAME = "pixabay"
     PIXABAY_ORIGINAL_API = "https://pixabay.com/api/"
+    # Pixabay asks API clients to cache search results for 24 hours.
+    CACHE_TTL = 24 * 3600
+    # Pixabay does not allow hotlinking, so the 640px web rendition is both scored and served from our uploads.
+    CLIP_RENDITION = "webformatURL"
     API_UPLOADS_FOLDER = os.path.join(UPLOAD_FOLDER, "pixabay")
     
-    def __init__(self, api_key):
-        super().__init__(api_key)
+    def __init__(self, api_key, downloader=None, store=None):
+        super().__init__(api_key, downloader, store)
 
 
     def fetch(self, keyword, num_images, blocked_urls):
 
         logging.info(f"Fetching up to {num_images} images for keyword '{keyword}' from Pixabay.")
 
+        clip_paths = []
+        posts_json = []
+
         try:
-            response = requests.get(
+            response = self.downloader.get(
                 self.PIXABAY_ORIGINAL_API,
                 params={
                     "key": self.api_key,
@@ -72,56 +114,62 @@ class PixabayProvider(APIProvider):
             response.raise_for_status()
             output = response.json()
 
-            clip_paths = []
-            posts_json = []
-
+            hits = []
             for hit in output.get("hits", []):
                 if looks_like_ai(hit):
                     continue
 
-                image_url = hit.get("webformatURL")
-                author = hit.get("user")
+                if not hit.get(self.CLIP_RENDITION):
+                    continue
 
-                if not image_url:
+                if hit.get("pageURL") in blocked_urls:
                     continue
-                
-                source_url = hit.get("pageURL")
 
-                if source_url in blocked_urls:
+                hits.append(hit)
+
+            saved = self.saveImages([hit[self.CLIP_RENDITION] for hit in hits], [hit["id"] for hit in hits])
+
+            for hit, result in zip(hits, saved):
+                if result is None:
                     continue
 
-                local_path, filename = self.saveImage(image_url, keyword)
+                local_path, filename = result
                 
                 clip_path = local_path.replace(UPLOAD_FOLDER, CLIP_MOUNT_PATH, 1)
                 clip_paths.append(clip_path)
 
-                public_url = url_for("serve_image", filename=f"pixabay/{filename}")
+                public_url = url_for("serve_image", filename=filename)
                 
                 posts_json.append({
                     "id": f"pixabay-{hit.get("id")}",
                     "author": {
-                        "name": author,
+                        "name": hit.get("user"),
                         "url": None
                     },
                     "description": None,
                     "keywords": [keyword],
                     "image_url": public_url,
-                    "source_url": source_url,
+                    "source_url": hit.get("pageURL"),
                     "provider": "pixabay"})
         except  HTTPError as e:
             logging.error(f"Failed to fetch from Pixabay. Error message: {e}")    
-        except (requests.RequestException, OSError, UnidentifiedImageError) as e:
-            logging.warning(f"Failed to fetch {image_url}: {e}")
+        except (requests.RequestException, ValueError) as e:
+            logging.warning(f"Failed to fetch from Pixabay: {e}")
         
         logging.info(f"Fetched {len(posts_json)} images from Pixabay.")
         return clip_paths, posts_json
 
 class PexelsProvider(APIProvider):
+    NAME = "pexels"
     PEXELS_URL = "https://api.pexels.com/v1/search"
+    CACHE_TTL = 6 * 3600
+    # "medium" is 350px high, enough for CLIP's 224px input; the UI hotlinks the 940px "large" rendition.
+    CLIP_RENDITION = "medium"
+    DISPLAY_RENDITION = "large"
     API_UPLOADS_FOLDER = os.path.join(UPLOAD_FOLDER, "pexels")
     
-    def __init__(self, api_key):
-        super().__init__(api_key)
+    def __init__(self, api_key, downloader=None, store=None):
+        super().__init__(api_key, downloader, store)
         self.HEADERS = {"Authorization": api_key}
     
     def fetch(self, keyword, num_images, blocked_urls):
@@ -129,7 +177,7 @@ class PexelsProvider(APIProvider):
         posts_json = []
         
         try:
-            response = requests.get(
+            response = self.downloader.get(
                 self.PEXELS_URL,
                 headers=self.HEADERS,
                 params={
@@ -140,55 +188,61 @@ class PexelsProvider(APIProvider):
             
             response.raise_for_status()
             output = response.json()
-            
+
+            photos = []
             for photo in output.get("photos", []):
                 if looks_like_ai(photo):
                     continue
 
-                image_url = photo["src"]["original"]
-                author = photo["photographer"]
+                if not photo["src"].get(self.CLIP_RENDITION) or not photo["src"].get(self.DISPLAY_RENDITION):
+                    continue
 
-                if not image_url:
+                if photo.get("url") in blocked_urls:
                     continue
-                
-                source_url = photo.get("url")
 
-                if source_url in blocked_urls:
+                photos.append(photo)
+
+            saved = self.saveImages([photo["src"][self.CLIP_RENDITION] for photo in photos], [photo["id"] for photo in photos])
+
+            for photo, result in zip(photos, saved):
+                if result is None:
                     continue
 
-                local_path, filename = self.saveImage(image_url, keyword)
+                local_path, filename = result
                 
                 clip_path = local_path.replace(UPLOAD_FOLDER, CLIP_MOUNT_PATH, 1)
                 clip_paths.append(clip_path)
-
-                public_url = url_for("serve_image", filename=f"pexels/{filename}")
                 
                 posts_json.append({
                     "id": f"pexels-{photo.get("id")}",
                     "author": {
-                        "name": author,
+                        "name": photo["photographer"],
                         "url": photo.get("photographer_url")
                     },
                     "description": photo.get("description"),
                     "keywords": [keyword],
-                    "image_url": public_url,
-                    "source_url": source_url,
+                    "image_url": photo["src"][self.DISPLAY_RENDITION],
+                    "source_url": photo.get("url"),
                     "provider": "pexels"})
         
         except  HTTPError as e:
             logging.error(f"Failed to fetch from Pexels. Error message: {e}")
-        except (requests.RequestException, OSError, UnidentifiedImageError) as e:
-            logging.warning(f"Failed to fetch {image_url}: {e}")
+        except (requests.RequestException, ValueError) as e:
+            logging.warning(f"Failed to fetch from Pexels: {e}")
         
         logging.info(f"Fetched {len(posts_json)} images from Pexels.")
         return clip_paths, posts_json
 
 class UnsplashProvider(APIProvider):
+    NAME = "unsplash"
     UNSPLASH_API = f"https://api.unsplash.com/search/photos"
+    # Unsplash requires hotlinking its image URLs: the 400px "small" rendition is scored, "regular" is shown.
+    CLIP_RENDITION = "small"
+    DISPLAY_RENDITION = "regular"
     API_UPLOADS_FOLDER = os.path.join(UPLOAD_FOLDER, "unsplash")
     
-    def __init__(self, api_key):
-        super().__init__(api_key)
+    def __init__(self, api_key, downloader=None, store=None):
+        super().__init__(api_key, downloader, store)
         self.HEADERS = {
             "Authorization": f"Client-ID {api_key}",
             "Accept-Version": "v1"
@@ -202,7 +256,7 @@ class UnsplashProvider(APIProvider):
         logging.info(f"Fetching up to {num_images} images for keyword '{keyword}' from Unsplash.")
 
         try:
-            response = requests.get(
+            response = self.downloader.get(
                 self.UNSPLASH_API, 
                 headers=self.HEADERS,
                 params={
@@ -214,29 +268,32 @@ class UnsplashProvider(APIProvider):
             response.raise_for_status()
             output = response.json()
 
+            results = []
             for result in output.get("results", []):
-                image_url = result["urls"]["regular"]
-                
-                if not image_url:
+                if not result["urls"].get(self.CLIP_RENDITION) or not result["urls"].get(self.DISPLAY_RENDITION):
                     continue
 
-                source_url = result.get("links").get("html")
-
-                if source_url in blocked_urls:
+                if result.get("links").get("html") in blocked_urls:
                     continue
 
-                requests.get(
+                # Unsplash requires a download-tracking call; it does not gate the image itself.
+                self.downloader.fire_and_forget(
                     result["links"]["download"],
                     headers=self.HEADERS,
                     timeout=5
                 )
+                results.append(result)
 
-                local_path, filename = self.saveImage(image_url, keyword)
+            saved = self.saveImages([result["urls"][self.CLIP_RENDITION] for result in results], [result["id"] for result in results])
+
+            for result, saved_image in zip(results, saved):
+                if saved_image is None:
+                    continue
+
+                local_path, filename = saved_image
                 
                 clip_path = local_path.replace(UPLOAD_FOLDER, CLIP_MOUNT_PATH, 1)
                 clip_paths.append(clip_path)
-
-                public_url = url_for("serve_image", filename=f"unsplash/{filename}")
                 
                 posts_json.append({
                     "id": f"unsplash-{result.get("id")}",
@@ -246,18 +303,23 @@ class UnsplashProvider(APIProvider):
                     },
                     "description": result.get("description"),
                     "keywords": [keyword],
-                    "image_url": public_url,
-                    "source_url": source_url,
+                    "image_url": result["urls"][self.DISPLAY_RENDITION],
+                    "source_url": result.get("links").get("html"),
                     "provider": "unsplash"})
         except  HTTPError as e:
             logging.error(f"Failed to fetch from Unsplash API. Error message: {e}")
-        except (requests.RequestException, OSError, UnidentifiedImageError) as e:
-            logging.warning(f"Failed to fetch {image_url}: {e}")
+        except (requests.RequestException, ValueError) as e:
+            logging.warning(f"Failed to fetch from Unsplash API: {e}")
         
         logging.info(f"Fetched {len(posts_json)} images from Unsplash.")
         return clip_paths, posts_json
         
     
+# Provider images, kept out of the local library search. The per-provider folders hold images saved before the blob store.
+PROVIDER_UPLOAD_FOLDERS = [BLOB_FOLDER] + [
+    provider.API_UPLOADS_FOLDER for provider in (PixabayProvider, PexelsProvider, UnsplashProvider)
+]
+
 def build_providers_list():
     providers = []
 
@@ -5,16 +5,34 @@ from flask_healthz import healthz, HealthError
 import json
 from werkzeug.utils import secure_filename
 from db_connector import db, Post, Keyword, BlacklistedImage
-from config import get_secret, build_posts_array, UPLOAD_FOLDER, verify_recaptcha, allowed_file
-from API_providers import API_PROVIDERS
+from config import get_secret, build_posts_array, UPLOAD_FOLDER, CLIP_MOUNT_PATH, verify_recaptcha, allowed_file
+from API_providers import API_PROVIDERS, PROVIDER_UPLOAD_FOLDERS
 from searcher import Searcher
+from search_scheduler import SearchScheduler
 from key_words import getKeyWords
+from index_queue import index_queue, ADD, REMOVE
+from deadline import Deadline
+from job_store import job_store, DONE, FAILED, FINAL_STATUSES
+from result_cache import result_cache_key, get_cached_results, store_results, blacklist_version
+from clip_client import clip_client
 import time
 import logging
 import uuid
+import requests
+from concurrent.futures import ThreadPoolExecutor
 
 MAX_SEARCH = 30
-search_jobs = {}
+UPLOADS_URL_PREFIX = "/api/uploads/"
+STREAM_KEEPALIVE = 15
+SEARCH_JOB_WORKERS = int(os.getenv("SEARCH_JOB_WORKERS", 8))
+# Optional early finish: stop once the k-th best score reaches EARLY_FINISH_SCORE,
+# or once EARLY_FINISH_AFTER seconds have passed with a full top-k. Both are off by default.
+EARLY_FINISH_SCORE = float(os.environ["EARLY_FINISH_SCORE"]) if os.getenv("EARLY_FINISH_SCORE") else None
+EARLY_FINISH_AFTER = float(os.environ["EARLY_FINISH_AFTER"]) if os.getenv("EARLY_FINISH_AFTER") else None
+# Default end-to-end budget of a search; requests may pass their own as budget_ms, 0 means unlimited.
+SEARCH_LATENCY_BUDGET_MS = int(os.getenv("SEARCH_LATENCY_BUDGET_MS", 20000))
+# Library posts per index job when the whole library is queued for indexing.
+REINDEX_CHUNK_SIZE = 256
 
 app = Flask(__name__)
 app.register_blueprint(healthz, url_prefix="/")
@@ -65,28 +83,63 @@ with app.app_context():
     db.create_all()
 
 searcher = Searcher(API_PROVIDERS)
+scheduler = SearchScheduler(app, searcher)
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_JOB_WORKERS, thread_name_prefix="search-job")
+
+def library_clip_path(source_url):
+    """CLIP path of a local post from its public URL; provider images have none."""
+    if not source_url or not source_url.startswith(UPLOADS_URL_PREFIX):
+        return None
+    return os.path.join(CLIP_MOUNT_PATH, source_url[len(UPLOADS_URL_PREFIX):])
 
 @app.route("/api/search", methods=['GET'])
 def start_search():
     query = request.args.get("s_query").lower()
     top_k = int(request.args.get("k", 30))
+    budget_ms = request.args.get("budget_ms", SEARCH_LATENCY_BUDGET_MS, type=int)
 
     job_id = str(uuid.uuid4())
 
-    search_jobs[job_id] = {
+    job_store.create(job_id, {
         "query": query,
         "top_k": top_k,
-        "status": "queued",
+        "budget_ms": budget_ms,
         "result": None,
-    }
+    })
+    if job_store.claim(job_id):
+        search_executor.submit(run_search_job, job_id)
 
     return jsonify({"job_id": job_id})
 
-def search_generator(job_id):
-    job = search_jobs[job_id]
-
-    query = job["query"].lower()
-    top_k = job["top_k"]
+def merge_scored(best_results, images, scores):
+    """Merge a scored batch into best_results, keeping each post's best score; returns the images that improved."""
+    # The same post can be found by several keywords and by the library index.
+    improved = []
+    for image, score in zip(images, scores):
+        if image["id"] not in best_results or score > best_results[image["id"]][1]:
+            best_results[image["id"]] = (image, score)
+            improved.append(image)
+    return improved
+
+def rank_best(best_results, top_k):
+    return sorted(best_results.values(), key=lambda x: x[1], reverse=True)[:top_k]
+
+def should_finish_early(ranked, top_k, elapsed):
+    """Whether a full top-k is good enough (EARLY_FINISH_SCORE) or late enough (EARLY_FINISH_AFTER) to stop."""
+    if len(ranked) < top_k:
+        return False
+    if EARLY_FINISH_SCORE is not None and ranked[-1][1] >= EARLY_FINISH_SCORE:
+        return True
+    return EARLY_FINISH_AFTER is not None and elapsed >= EARLY_FINISH_AFTER
+
+def search_generator(query, top_k, budget_ms=SEARCH_LATENCY_BUDGET_MS):
+    deadline = Deadline(budget_ms / 1000) if budget_ms > 0 else None
+
+    cache_key = result_cache_key(query, top_k, API_PROVIDERS)
+    cached_images = get_cached_results(cache_key)
+    if cached_images is not None:
+        yield {"event": "done", "data": cached_images}
+        return
 
     keywords = getKeyWords(query)
 
@@ -95,47 +148,101 @@ def search_generator(job_id):
         return
     
         
-    all_results = []
-    total = len(keywords)
-    done = 0
-
-    for tag in keywords:         
-        yield {
-            "event": "progress",
-            "data": {
-                "current": done,
-                "total": total,
-                "percent": int(done / total * 100),
-                "tag": tag,
-            },
-        }
-        top_images, top_scores = searcher.get_similar_images(
-            tag, query, MAX_SEARCH, top_k
-        )
-
-        for image, score in zip(top_images, top_scores):
-            all_results.append((image, score))
-    
-        done += 1
-    
-    all_results.sort(key = lambda x: x[1], reverse=True)
-    final_results = all_results[:top_k]
-    final_images = [item[0] for item in final_results]
-    
-    job["result"] = final_images
+    started = time.monotonic()
+    best_results = {}
+    finished_early = False
+    failed_units = 0
+
+    for event in scheduler.run(keywords, query, MAX_SEARCH, top_k, deadline):
+        if event["event"] == "cut":
+            logging.warning(f"Search '{query}' ran out of its {budget_ms} ms budget; {len(event['data'])} units cut.")
+            finished_early = True
+        elif event["event"] == "progress" and event["data"]["failed"]:
+            failed_units += 1
+
+        if event["event"] != "scored":
+            yield event
+            continue
+
+        scored = event["data"]
+        new_images = merge_scored(best_results, scored["images"], scored["scores"])
+        ranked = rank_best(best_results, top_k)
+        if new_images:
+            yield {
+                "event": "partial",
+                "data": {
+                    "tag": scored["tag"],
+                    "images": new_images,
+                    "results": [image for image, _ in ranked],
+                },
+            }
+
+        if should_finish_early(ranked, top_k, time.monotonic() - started):
+            # Units still running finish in the background and warm the keyword cache.
+            finished_early = True
+            break
+
+    final_images = [image for image, _ in rank_best(best_results, top_k)]
+
+    # An early, cut or partly failed answer is not the full result, so only complete searches are cached.
+    if not finished_early and not failed_units:
+        store_results(cache_key, final_images)
+    elif failed_units:
+        logging.warning(f"Search '{query}' had {failed_units} failed units; its results are not cached.")
 
     yield {
         "event": "done",
         "data": final_images
     }
 
+def run_search_job(job_id):
+    """Run a search to completion, recording its events in the job store for stream and poll clients."""
+    job = job_store.get(job_id)
+    if job is None:
+        return
+
+    try:
+        with app.app_context():
+            for event in search_generator(job["query"].lower(), job["top_k"], job["budget_ms"]):
+                job_store.append_event(job_id, event)
+                if event["event"] == "cut":
+                    job_store.update(job_id, cut=event["data"])
+                elif event["event"] == "done":
+                    job_store.update(job_id, status=DONE, result=event["data"])
+                elif event["event"] == "error":
+                    job_store.update(job_id, status=FAILED)
+    except Exception:
+        logging.exception(f"Search job {job_id} failed")
+        job_store.append_event(job_id, {"event": "error", "data": "Search failed"})
+        job_store.update(job_id, status=FAILED)
+
 @app.get("/api/search/stream/<job_id>")
 def stream_search(job_id):
+    if job_store.get(job_id) is None:
+        return jsonify({"error": "Unknown search job"}), 404
+
+    # Clients that reconnect resume after the last event they received.
+    last_event_id = request.headers.get("Last-Event-ID", request.args.get("last_event_id"))
+    start = int(last_event_id) + 1 if last_event_id and last_event_id.isdigit() else 0
 
     def event_stream():
-        for payload in search_generator(job_id):
-            yield f"event: {payload['event']}\n"
-            yield f"data: {json.dumps(payload['data'])}\n\n"
+        index = start
+        while True:
+            events = job_store.events_since(job_id, index, timeout=STREAM_KEEPALIVE)
+            if not events:
+                job = job_store.get(job_id)
+                if job is None or job["status"] in FINAL_STATUSES:
+                    return
+                yield ": keep-alive\n\n"
+                continue
+
+            for payload in events:
+                yield f"id: {index}\n"
+                yield f"event: {payload['event']}\n"
+                yield f"data: {json.dumps(payload['data'])}\n\n"
+                index += 1
+                if payload["event"] in ("done", "error"):
+                    return
     
     return Response(
         stream_with_context(event_stream()),
@@ -146,6 +253,22 @@ def stream_search(job_id):
         }
     )
 
+@app.get("/api/search/<job_id>")
+def poll_search(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown search job"}), 404
+
+    since = request.args.get("since", 0, type=int)
+    events = job_store.events_since(job_id, since)
+    return jsonify({
+        "status": job["status"],
+        "events": events,
+        "next": since + len(events),
+        "result": job.get("result"),
+        "cut": job.get("cut", []),
+    })
+
 @app.route('/api/createPost', methods=['POST'])
 def post_image():
     author = request.form.get("author")
@@ -190,6 +313,8 @@ def post_image():
     db.session.add(new_post)
     db.session.commit()
 
+    index_queue.enqueue(ADD, [filepath.replace(UPLOAD_FOLDER, CLIP_MOUNT_PATH, 1)])
+
     return jsonify({"message": "Post created"}), 201
 
 
@@ -209,7 +334,7 @@ def get_posts_by_keywords(keyword_name):
     return jsonify(build_posts_array(posts)), 200
 
 
-@app.route('/api/uploads/<path:filename>')
+@app.route(UPLOADS_URL_PREFIX + '<path:filename>')
 def serve_image(filename):
     safe_path = os.path.join(UPLOAD_FOLDER, filename)
     if not os.path.exists(safe_path):
@@ -294,6 +419,8 @@ def contribute_image():
         )
         db.session.add(new_post)
         db.session.commit()
+
+        index_queue.enqueue(ADD, [image_path.replace(UPLOAD_FOLDER, CLIP_MOUNT_PATH, 1)])
         
         logging.info(f"New contribution: post_id={new_post.id}, filename={unique_filename}")
         
@@ -355,17 +482,55 @@ def block_image(image_id):
     img = BlacklistedImage.query.get_or_404(image_id)
     img.status = "blocked"
     db.session.commit()
+    blacklist_version.bump()
+
+    clip_path = library_clip_path(img.source_url)
+    if clip_path:
+        index_queue.enqueue(REMOVE, [clip_path])
 
     return jsonify({"message": "Image blocked"})
 
 @app.route("/api/blacklist/<int:image_id>", methods=['DELETE'])
 def remove_from_blacklist(image_id):
     img = BlacklistedImage.query.get_or_404(image_id)
+    was_blocked = img.status == "blocked"
+    clip_path = library_clip_path(img.source_url)
     db.session.delete(img)
     db.session.commit()
 
+    if was_blocked:
+        blacklist_version.bump()
+        if clip_path:
+            index_queue.enqueue(ADD, [clip_path])
+
     return jsonify({"message": "Image removed from blacklist"})
 
+@app.route("/api/index/rebuild", methods=['POST'])
+def rebuild_library_index():
+    """Compact the CLIP vector index down to the library, then queue every library post for indexing.
+
+    Posts that are already indexed are skipped by CLIP, so this also recovers a lost index.
+    """
+    provider_prefixes = [folder.replace(UPLOAD_FOLDER, CLIP_MOUNT_PATH, 1) for folder in PROVIDER_UPLOAD_FOLDERS]
+    try:
+        compacted = clip_client.index_rebuild(provider_prefixes)
+    except requests.RequestException as e:
+        return jsonify({"error": f"CLIP index rebuild failed: {e}"}), 502
+
+    clip_paths = [
+        os.path.join(CLIP_MOUNT_PATH, post.image_path)
+        for post in Post.query.all()
+        if os.path.exists(os.path.join(UPLOAD_FOLDER, post.image_path))
+    ]
+    for start in range(0, len(clip_paths), REINDEX_CHUNK_SIZE):
+        index_queue.enqueue(ADD, clip_paths[start:start + REINDEX_CHUNK_SIZE])
+
+    return jsonify({"removed": compacted["removed"], "queued": len(clip_paths)})
+
+@app.route("/api/worker/stats", methods=['GET'])
+def worker_stats():
+    return jsonify(index_queue.stats())
+
 @app.route('/health', methods=['GET'])
 def healthcheck():
     return "OK", 200
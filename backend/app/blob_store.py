@@ -0,0 +1,175 @@
+import os
+import time
+import fcntl
+import hashlib
+import logging
+import threading
+import uuid
+from config import UPLOAD_FOLDER
+
+BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, "blobs")
+BLOB_STORE_MAX_BYTES = int(os.getenv("BLOB_STORE_MAX_BYTES", 5 * 1024 ** 3))
+# A collection frees space down to this share of the cap, so it does not run on every write.
+BLOB_GC_LOW_WATERMARK = 0.9
+BLOB_GC_EVERY_BYTES = int(os.getenv("BLOB_GC_EVERY_BYTES", 64 * 1024 ** 2))
+
+
+class BlobStore:
+    """Content-addressed image storage on the shared volume.
+
+    Each image is stored once, as objects/<aa>/<sha256>.<ext>, however many
+    keywords or searches find it. A source key (provider, photo id, rendition)
+    maps to its blob, so repeat fetches of a known image skip the download.
+
+    Blobs referenced by live keyword cache entries are pinned until those entries
+    expire; once the store outgrows BLOB_STORE_MAX_BYTES the least recently used
+    unpinned blobs are deleted. Last use is kept in atime, leaving mtime alone so
+    the CLIP service's file index stays valid.
+    """
+
+    def __init__(self, root=BLOB_FOLDER, max_bytes=BLOB_STORE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(root, "objects")
+        self.sources_dir = os.path.join(root, "sources")
+        self.pins_dir = os.path.join(root, "pins")
+        self._written = 0
+        self._lock = threading.Lock()
+
+    def _source_path(self, source_key):
+        digest = hashlib.sha1(source_key.encode()).hexdigest()
+        return os.path.join(self.sources_dir, digest[:2], digest)
+
+    def _object_path(self, content_hash, extension):
+        return os.path.join(self.objects_dir, content_hash[:2], f"{content_hash}.{extension}")
+
+    def _write_atomic(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _touch(self, path):
+        stat = os.stat(path)
+        os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+
+    @staticmethod
+    def content_hash(path):
+        return os.path.basename(path).split(".", 1)[0]
+
+    def lookup(self, source_key):
+        """Local path of the blob stored for source_key, or None if it was never stored or has been collected."""
+        try:
+            with open(self._source_path(source_key)) as f:
+                path = os.path.join(self.root, f.read())
+            self._touch(path)
+            return path
+        except FileNotFoundError:
+            return None
+
+    def put(self, source_key, data, extension):
+        content_hash = hashlib.sha256(data).hexdigest()
+        path = self._object_path(content_hash, extension)
+        if os.path.exists(path):
+            self._touch(path)
+        else:
+            self._write_atomic(path, data)
+            self._count_written(len(data))
+        self._write_atomic(self._source_path(source_key), os.path.relpath(path, self.root).encode())
+        return path
+
+    def pin(self, paths, ttl):
+        """Keep blobs alive for at least ttl seconds; a pin is a file whose mtime is its expiry."""
+        expires_at = time.time() + ttl
+        for path in paths:
+            if not path.startswith(self.objects_dir):
+                continue
+            pin_path = os.path.join(self.pins_dir, self.content_hash(path))
+            try:
+                if os.stat(pin_path).st_mtime >= expires_at:
+                    continue
+            except FileNotFoundError:
+                os.makedirs(self.pins_dir, exist_ok=True)
+                open(pin_path, "a").close()
+            os.utime(pin_path, (expires_at, expires_at))
+
+    def _pinned(self, content_hash, now):
+        try:
+            return os.stat(os.path.join(self.pins_dir, content_hash)).st_mtime > now
+        except FileNotFoundError:
+            return False
+
+    def _count_written(self, size):
+        with self._lock:
+            self._written += size
+            if self._written < BLOB_GC_EVERY_BYTES:
+                return
+            self._written = 0
+        threading.Thread(target=self.collect, name="blob-gc", daemon=True).start()
+
+    def _iter_files(self, directory):
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in filenames:
+                yield os.path.join(dirpath, filename)
+
+    def collect(self):
+        """Delete least recently used unpinned blobs until the store is under its low watermark."""
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, ".gc.lock"), "w") as lock_file:
+            try:
+                # Only one process collects at a time; the others skip this round.
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+
+            blobs = []
+            for path in self._iter_files(self.objects_dir):
+                if path.endswith(".tmp"):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                blobs.append((stat.st_atime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in blobs)
+            if total <= self.max_bytes:
+                return 0
+
+            target = self.max_bytes * BLOB_GC_LOW_WATERMARK
+            now = time.time()
+            freed = 0
+            for _, size, path in sorted(blobs):
+                if total - freed <= target:
+                    break
+                if self._pinned(self.content_hash(path), now):
+                    continue
+                try:
+                    os.remove(path)
+                    freed += size
+                except FileNotFoundError:
+                    pass
+
+            self._prune(now)
+            logging.info(f"Blob store collected {freed} bytes ({total} bytes before).")
+            return freed
+
+    def _prune(self, now):
+        """Drop source mappings whose blob is gone and pins that have expired."""
+        for path in self._iter_files(self.sources_dir):
+            try:
+                with open(path) as f:
+                    if not os.path.exists(os.path.join(self.root, f.read())):
+                        os.remove(path)
+            except FileNotFoundError:
+                pass
+        for path in self._iter_files(self.pins_dir):
+            try:
+                if os.stat(path).st_mtime <= now:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+blob_store = BlobStore()
@@ -0,0 +1,178 @@
+import os
+import json
+import hashlib
+import logging
+import time
+import threading
+import requests
+from collections import OrderedDict
+from config import UPLOAD_FOLDER, CLIP_MOUNT_PATH
+from deadline import request_timeout
+
+model_host = os.getenv("MODEL_HOST")
+model_port = os.getenv("MODEL_PORT")
+
+# "binary" sends cache keys and uploads only the images CLIP has not embedded yet;
+# "path" sends shared-volume paths and lets CLIP read the files itself.
+CLIP_TRANSFER_MODE = os.getenv("CLIP_TRANSFER_MODE", "binary")
+IMAGE_KEY_INDEX_SIZE = int(os.getenv("IMAGE_KEY_INDEX_SIZE", 50000))
+MODEL_VERSION_REFRESH = 60
+# While CLIP is unreachable, searches skip the version check for this long instead of each waiting on it.
+MODEL_VERSION_RETRY = 5
+CLIP_REQUEST_TIMEOUT = float(os.getenv("CLIP_REQUEST_TIMEOUT", 120))
+
+
+# Keys are computed here and by the blob store as sha256; binary mode is only used while
+# CLIP keys its cache the same way (CLIP_CACHE_HASH, reported by /version).
+CONTENT_KEY_HASH = "sha256"
+
+
+def content_key(image_bytes):
+    return f"{CONTENT_KEY_HASH}:" + hashlib.sha256(image_bytes).hexdigest()
+
+
+class ImageKeyIndex:
+    """Bounded clip path -> content key map, filled when images are saved so they never need re-hashing."""
+
+    def __init__(self, max_size=IMAGE_KEY_INDEX_SIZE):
+        self.max_size = max_size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, clip_path):
+        with self._lock:
+            key = self._keys.get(clip_path)
+            if key is not None:
+                self._keys.move_to_end(clip_path)
+            return key
+
+    def put(self, clip_path, key):
+        with self._lock:
+            self._keys[clip_path] = key
+            self._keys.move_to_end(clip_path)
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+
+image_key_index = ImageKeyIndex()
+
+def local_path_for(clip_path):
+    return clip_path.replace(CLIP_MOUNT_PATH, UPLOAD_FOLDER, 1)
+
+def register_image_key(local_path, key):
+    clip_path = local_path.replace(UPLOAD_FOLDER, CLIP_MOUNT_PATH, 1)
+    image_key_index.put(clip_path, key)
+
+
+class ClipClient:
+    def __init__(self, base_url=None, transfer_mode=CLIP_TRANSFER_MODE):
+        self.base_url = base_url or f"http://{model_host}:{model_port}"
+        self.transfer_mode = transfer_mode
+        self.session = requests.Session()
+        self._model_version = None
+        self._cache_hash = None
+        self._model_version_checked = 0.0
+
+    def _key_for(self, clip_path):
+        key = image_key_index.get(clip_path)
+        if key is None:
+            with open(local_path_for(clip_path), "rb") as f:
+                key = content_key(f.read())
+            image_key_index.put(clip_path, key)
+        return key
+
+    def uses_binary_transfer(self):
+        if self.transfer_mode != "binary":
+            return False
+        self.model_version()
+        # With any other CLIP hash the uploads would be cached under keys CLIP itself never computes.
+        return self._cache_hash in (None, CONTENT_KEY_HASH)
+
+    def similarity(self, clip_paths, query, top_k):
+        if not self.uses_binary_transfer():
+            response = self.session.post(
+                f"{self.base_url}/similarity",
+                json={
+                    "images": clip_paths,
+                    "query": query,
+                    "top_k": top_k
+                },
+                timeout=request_timeout(CLIP_REQUEST_TIMEOUT)
+            )
+            response.raise_for_status()
+            return response.json()
+
+        keys = [self._key_for(path) for path in clip_paths]
+
+        response = self.session.post(f"{self.base_url}/similarity/known", json={"keys": keys}, timeout=request_timeout(CLIP_REQUEST_TIMEOUT))
+        response.raise_for_status()
+        missing = set(response.json()["missing"])
+
+        files = []
+        for key, clip_path in zip(keys, clip_paths):
+            if key in missing:
+                missing.discard(key)
+                with open(local_path_for(clip_path), "rb") as f:
+                    files.append(("images", (key, f.read(), "application/octet-stream")))
+
+        response = self.session.post(
+            f"{self.base_url}/similarity/upload",
+            data={
+                "query": query,
+                "keys": json.dumps(keys),
+                "top_k": top_k
+            },
+            files=files or None,
+            timeout=request_timeout(CLIP_REQUEST_TIMEOUT)
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def model_version(self):
+        """Model id served by CLIP, refreshed at most once a minute; None if CLIP is unreachable."""
+        if time.monotonic() - self._model_version_checked > MODEL_VERSION_REFRESH:
+            try:
+                response = self.session.get(f"{self.base_url}/version", timeout=2)
+                response.raise_for_status()
+                version = response.json()
+                cache_hash = version.get("hash", CONTENT_KEY_HASH)
+                if cache_hash not in (CONTENT_KEY_HASH, self._cache_hash):
+                    logging.warning(f"CLIP keys its cache with {cache_hash}, not {CONTENT_KEY_HASH}; sending image paths instead of uploads.")
+                self._model_version = version["model"]
+                self._cache_hash = cache_hash
+                self._model_version_checked = time.monotonic()
+            except requests.RequestException:
+                self._model_version = None
+                self._model_version_checked = time.monotonic() - MODEL_VERSION_REFRESH + MODEL_VERSION_RETRY
+        return self._model_version
+
+    def search(self, query, top_k, exclude_prefixes=()):
+        response = self.session.post(
+            f"{self.base_url}/search",
+            json={
+                "query": query,
+                "top_k": top_k,
+                "exclude_prefixes": list(exclude_prefixes)
+            },
+            timeout=request_timeout(CLIP_REQUEST_TIMEOUT)
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def index_add(self, clip_paths):
+        response = self.session.post(f"{self.base_url}/index/add", json={"sources": clip_paths})
+        response.raise_for_status()
+        return response.json()
+
+    def index_remove(self, clip_paths):
+        response = self.session.post(f"{self.base_url}/index/remove", json={"sources": clip_paths})
+        response.raise_for_status()
+        return response.json()
+
+    def index_rebuild(self, exclude_prefixes=()):
+        response = self.session.post(f"{self.base_url}/index/rebuild", json={"exclude_prefixes": list(exclude_prefixes)})
+        response.raise_for_status()
+        return response.json()
+
+
+clip_client = ClipClient()
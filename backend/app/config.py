@@ -7,6 +7,19 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 UPLOAD_FOLDER = os.path.join(BASE_DIR, "uploads")
 CLIP_MOUNT_PATH = "/data/images"
 
+REDIS_IN_USE = os.getenv("REDIS_IN_USE", "false") == "true"
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+
+_redis_client = None
+
+def get_redis_client():
+    global _redis_client
+    if _redis_client is None:
+        import redis
+        _redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+    return _redis_client
+
 def get_secret(name):
     file_var = os.getenv(f"{name}_FILE")
     if file_var and os.path.exists(file_var):
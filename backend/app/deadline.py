@@ -0,0 +1,44 @@
+import time
+import contextvars
+from requests.exceptions import Timeout
+
+# Deadline of the search the current code runs for; executors copy it into their worker threads.
+current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+
+class DeadlineExceeded(Timeout):
+    """Raised instead of starting a request when the search's latency budget is already spent."""
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def shortened(self, fraction):
+        """A deadline that expires when only fraction of the remaining time is left."""
+        return Deadline(max(self.remaining(), 0) * (1 - fraction))
+
+
+def request_timeout(default):
+    """Timeout for an outgoing request: default, capped by the current deadline if there is one."""
+    deadline = current_deadline.get()
+    if deadline is None:
+        return default
+    remaining = deadline.remaining()
+    if remaining <= 0:
+        raise DeadlineExceeded("Search latency budget exhausted")
+    return min(default, remaining)
+
+
+def with_current_context(fn, *args, deadline=None):
+    """Bind fn to a copy of the current context, optionally with a different deadline, for use in another thread."""
+    context = contextvars.copy_context()
+    if deadline is not None:
+        context.run(current_deadline.set, deadline)
+    return lambda: context.run(fn, *args)
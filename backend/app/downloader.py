@@ -0,0 +1,71 @@
+import os
+import logging
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from deadline import request_timeout, with_current_context
+
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", 16))
+DOWNLOAD_MAX_PER_HOST = int(os.getenv("DOWNLOAD_MAX_PER_HOST", 6))
+
+
+def build_session(pool_size=DOWNLOAD_WORKERS):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class ImageDownloader:
+    """Shared HTTP engine for provider API calls and image downloads.
+
+    Reuses pooled keep-alive connections and caps concurrent requests per host,
+    so one provider cannot starve the others.
+    """
+
+    def __init__(self, session=None, max_workers=DOWNLOAD_WORKERS, max_per_host=DOWNLOAD_MAX_PER_HOST):
+        self.session = session or build_session(max_workers)
+        self.max_per_host = max_per_host
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="download")
+        self._host_limits = {}
+        self._lock = threading.Lock()
+
+    def _host_limit(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_limits[host]
+
+    def get(self, url, **kwargs):
+        with self._host_limit(url):
+            # Waiting for a host slot uses up the search's budget too, so the timeout is taken afterwards.
+            if "timeout" in kwargs:
+                kwargs["timeout"] = request_timeout(kwargs["timeout"])
+            return self.session.get(url, **kwargs)
+
+    def map(self, fn, items):
+        """Run fn over items in parallel. Returns results in input order; failures come back as exceptions."""
+        futures = [self._executor.submit(with_current_context(fn, item)) for item in items]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def fire_and_forget(self, url, **kwargs):
+        def run():
+            try:
+                self.get(url, **kwargs)
+            except requests.RequestException as e:
+                logging.warning(f"Background request to {url} failed: {e}")
+
+        self._executor.submit(run)
+
+
+image_downloader = ImageDownloader()
@@ -0,0 +1,38 @@
+import threading
+from config import REDIS_IN_USE
+from job_queue import build_job_queue, new_job
+from worker import start_background_worker, INDEX_ADD, INDEX_REMOVE
+
+ADD = INDEX_ADD
+REMOVE = INDEX_REMOVE
+
+
+class IndexQueue:
+    """Producer side of the embedding job queue.
+
+    With Redis the jobs are consumed by the separate worker service; without it an
+    in-process worker thread is started on first use.
+    """
+
+    def __init__(self, job_queue=None):
+        self.job_queue = job_queue or build_job_queue()
+        self._local_worker = None
+        self._lock = threading.Lock()
+
+    def enqueue(self, action, clip_paths):
+        if not clip_paths:
+            return
+        if not REDIS_IN_USE:
+            self._ensure_local_worker()
+        self.job_queue.push(new_job(action, paths=list(clip_paths)))
+
+    def _ensure_local_worker(self):
+        with self._lock:
+            if self._local_worker is None:
+                self._local_worker = start_background_worker(self.job_queue)
+
+    def stats(self):
+        return {"queue": self.job_queue.depth(), "worker": self.job_queue.read_stats()}
+
+
+index_queue = IndexQueue()
@@ -0,0 +1,169 @@
+import json
+import time
+import uuid
+import socket
+import threading
+from collections import deque
+from config import REDIS_IN_USE, get_redis_client
+
+EMBEDDING_QUEUE = "embedding_jobs"
+DONE_MARKER_TTL = 24 * 3600
+
+
+def new_job(job_type, **payload):
+    return {"id": uuid.uuid4().hex, "type": job_type, "attempts": 0, **payload}
+
+
+class LocalJobQueue:
+    """In-process queue with the same interface as RedisJobQueue, for single-process runs and tests."""
+
+    def __init__(self):
+        self._jobs = deque()
+        self._in_flight = {}
+        self._stats = {}
+        self._cond = threading.Condition()
+
+    def push(self, job):
+        with self._cond:
+            self._jobs.appendleft(job)
+            self._cond.notify()
+
+    def pop_batch(self, max_size, max_wait, idle_timeout=1.0):
+        """Block up to idle_timeout for a first job, then collect more for at most max_wait seconds."""
+        batch = []
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._jobs, timeout=idle_timeout):
+                return batch
+            deadline = time.monotonic() + max_wait
+            while len(batch) < max_size:
+                if self._jobs:
+                    job = self._jobs.pop()
+                    self._in_flight[job["id"]] = job
+                    batch.append(job)
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(timeout=remaining):
+                    break
+        return batch
+
+    def ack(self, jobs):
+        with self._cond:
+            for job in jobs:
+                self._in_flight.pop(job["id"], None)
+
+    def is_done(self, job):
+        # Acked jobs are never delivered again here, so there is nothing to remember them by.
+        return False
+
+    def requeue(self, jobs):
+        """Put jobs back at the head of the queue, in order."""
+        with self._cond:
+            for job in reversed(jobs):
+                self._in_flight.pop(job["id"], None)
+                self._jobs.append(job)
+            self._cond.notify()
+
+    def depth(self):
+        with self._cond:
+            return {"pending": len(self._jobs), "in_flight": len(self._in_flight)}
+
+    def publish_stats(self, stats):
+        self._stats = dict(stats)
+
+    def read_stats(self):
+        return dict(self._stats)
+
+
+class RedisJobQueue:
+    """Reliable Redis list queue.
+
+    Jobs are moved atomically from the pending list to a per-consumer processing
+    list and only removed from it on ack, so a crashed worker's jobs are recovered
+    on restart. Acks are idempotent: a done marker is set per job id, and
+    redelivered jobs that already carry one are skipped.
+    """
+
+    def __init__(self, client, name=EMBEDDING_QUEUE, consumer=None):
+        self.client = client
+        self.pending = name
+        self.processing = f"{name}:processing:{consumer or socket.gethostname()}"
+        self.stats_key = f"{name}:stats"
+        self.name = name
+
+    def push(self, job):
+        self.client.lpush(self.pending, json.dumps(job))
+
+    def recover(self):
+        """Return jobs left in this consumer's processing list (after a crash) to the pending list."""
+        recovered = 0
+        while self.client.lmove(self.processing, self.pending, "LEFT", "RIGHT") is not None:
+            recovered += 1
+        return recovered
+
+    def pop_batch(self, max_size, max_wait, idle_timeout=1.0):
+        batch = []
+        raw = self.client.blmove(self.pending, self.processing, idle_timeout, "RIGHT", "LEFT")
+        if raw is None:
+            return batch
+        batch.append(self._decode(raw))
+
+        deadline = time.monotonic() + max_wait
+        while len(batch) < max_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            raw = self.client.lmove(self.pending, self.processing, "RIGHT", "LEFT")
+            if raw is None:
+                raw = self.client.blmove(self.pending, self.processing, max(remaining, 0.01), "RIGHT", "LEFT")
+                if raw is None:
+                    break
+            batch.append(self._decode(raw))
+        return batch
+
+    def _decode(self, raw):
+        job = json.loads(raw)
+        job["_raw"] = raw
+        return job
+
+    def ack(self, jobs):
+        pipe = self.client.pipeline()
+        for job in jobs:
+            pipe.set(f"{self.name}:done:{job['id']}", 1, ex=DONE_MARKER_TTL)
+            pipe.lrem(self.processing, 1, job["_raw"])
+        pipe.execute()
+
+    def is_done(self, job):
+        return bool(self.client.exists(f"{self.name}:done:{job['id']}"))
+
+    def requeue(self, jobs):
+        """Put jobs back at the head of the pending list, in order."""
+        if not jobs:
+            return
+        raws = [job.pop("_raw") for job in jobs]
+        pipe = self.client.pipeline()
+        pipe.rpush(self.pending, *[json.dumps(job) for job in reversed(jobs)])
+        for raw in raws:
+            pipe.lrem(self.processing, 1, raw)
+        pipe.execute()
+
+    def depth(self):
+        in_flight = sum(
+            self.client.llen(key)
+            for key in self.client.scan_iter(f"{self.name}:processing:*")
+        )
+        return {"pending": self.client.llen(self.pending), "in_flight": in_flight}
+
+    def publish_stats(self, stats):
+        self.client.hset(self.stats_key, mapping={key: json.dumps(value) for key, value in stats.items()})
+
+    def read_stats(self):
+        return {
+            key.decode(): json.loads(value)
+            for key, value in self.client.hgetall(self.stats_key).items()
+        }
+
+
+def build_job_queue(name=EMBEDDING_QUEUE):
+    if REDIS_IN_USE:
+        return RedisJobQueue(get_redis_client(), name)
+    return LocalJobQueue()
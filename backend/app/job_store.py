@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from config import REDIS_IN_USE, get_redis_client
+
+SEARCH_JOB_TTL = int(os.getenv("SEARCH_JOB_TTL", 900))
+SEARCH_JOB_MAX_ENTRIES = int(os.getenv("SEARCH_JOB_MAX_ENTRIES", 1000))
+EVENT_POLL_INTERVAL = 0.1
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "error"
+FINAL_STATUSES = (DONE, FAILED)
+
+
+class LocalJobStore:
+    """In-process search job registry with TTL and entry-count eviction, used when Redis is absent.
+
+    Every job keeps the list of events it produced, so any number of stream
+    clients can read them from any position while the job runs on its own.
+    """
+
+    def __init__(self, ttl=SEARCH_JOB_TTL, max_entries=SEARCH_JOB_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._jobs = OrderedDict()
+        self._cond = threading.Condition()
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._jobs:
+            job_id, (expires_at, _, _) = next(iter(self._jobs.items()))
+            if expires_at >= now and len(self._jobs) <= self.max_entries:
+                break
+            del self._jobs[job_id]
+
+    def create(self, job_id, job):
+        with self._cond:
+            self._jobs[job_id] = (time.monotonic() + self.ttl, {**job, "status": QUEUED}, [])
+            self._evict()
+
+    def get(self, job_id):
+        with self._cond:
+            entry = self._jobs.get(job_id)
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            return dict(entry[1])
+
+    def update(self, job_id, **fields):
+        with self._cond:
+            entry = self._jobs.get(job_id)
+            if entry is not None:
+                entry[1].update(fields)
+                self._cond.notify_all()
+
+    def claim(self, job_id):
+        """Move a queued job to running; returns False if another caller already did."""
+        with self._cond:
+            entry = self._jobs.get(job_id)
+            if entry is None or entry[1]["status"] != QUEUED:
+                return False
+            entry[1]["status"] = RUNNING
+            return True
+
+    def append_event(self, job_id, event):
+        with self._cond:
+            entry = self._jobs.get(job_id)
+            if entry is not None:
+                entry[2].append(event)
+                self._cond.notify_all()
+
+    def events_since(self, job_id, index, timeout=0):
+        """Events from position index on, waiting up to timeout seconds for new ones."""
+        with self._cond:
+            def available():
+                entry = self._jobs.get(job_id)
+                return entry is None or len(entry[2]) > index or entry[1]["status"] in FINAL_STATUSES
+
+            self._cond.wait_for(available, timeout=timeout)
+            entry = self._jobs.get(job_id)
+            return [] if entry is None else list(entry[2][index:])
+
+
+class RedisJobStore:
+    """Search job registry shared by all backend processes.
+
+    A job is a JSON string plus an event list, both expiring after the job TTL,
+    so Redis memory stays bounded without any cleanup pass.
+    """
+
+    def __init__(self, client, namespace="search_job", ttl=SEARCH_JOB_TTL):
+        self.client = client
+        self.namespace = namespace
+        self.ttl = ttl
+
+    def _key(self, job_id):
+        return f"{self.namespace}:{job_id}"
+
+    def _events_key(self, job_id):
+        return f"{self.namespace}:{job_id}:events"
+
+    def create(self, job_id, job):
+        self.client.set(self._key(job_id), json.dumps({**job, "status": QUEUED}), ex=self.ttl)
+
+    def get(self, job_id):
+        raw = self.client.get(self._key(job_id))
+        return None if raw is None else json.loads(raw)
+
+    def update(self, job_id, **fields):
+        key = self._key(job_id)
+
+        def apply(pipe):
+            # WATCH makes the write fail, and the transaction retry, if another process
+            # updated the job in between, so concurrent updates never drop each other's fields.
+            raw = pipe.get(key)
+            if raw is None:
+                return
+            job = {**json.loads(raw), **fields}
+            pipe.multi()
+            pipe.set(key, json.dumps(job), ex=self.ttl)
+
+        self.client.transaction(apply, key)
+
+    def claim(self, job_id):
+        """Move a queued job to running; returns False if another process already did."""
+        if not self.client.set(self._key(job_id) + ":claimed", 1, nx=True, ex=self.ttl):
+            return False
+        self.update(job_id, status=RUNNING)
+        return True
+
+    def append_event(self, job_id, event):
+        pipe = self.client.pipeline()
+        pipe.rpush(self._events_key(job_id), json.dumps(event))
+        pipe.expire(self._events_key(job_id), self.ttl)
+        pipe.execute()
+
+    def events_since(self, job_id, index, timeout=0):
+        deadline = time.monotonic() + timeout
+        while True:
+            events = [json.loads(raw) for raw in self.client.lrange(self._events_key(job_id), index, -1)]
+            if events or time.monotonic() >= deadline:
+                return events
+            job = self.get(job_id)
+            if job is None or job["status"] in FINAL_STATUSES:
+                # The last events may have been appended between the two reads.
+                return [json.loads(raw) for raw in self.client.lrange(self._events_key(job_id), index, -1)]
+            time.sleep(EVENT_POLL_INTERVAL)
+
+
+def build_job_store():
+    if REDIS_IN_USE:
+        return RedisJobStore(get_redis_client())
+    return LocalJobStore()
+
+
+job_store = build_job_store()
@@ -1,10 +1,14 @@
+import threading
 from rake_nltk import Rake
 import nltk
 
 # nltk.download('punkt_tab')
 # nltk.download('stopwords')
 rake_nltk_var = Rake()
+# Rake keeps the last extraction as state, so concurrent searches must not interleave.
+rake_lock = threading.Lock()
 
 def getKeyWords(text):
-    rake_nltk_var.extract_keywords_from_text(text)  
-    return rake_nltk_var.get_ranked_phrases()
\ No newline at end of file
+    with rake_lock:
+        rake_nltk_var.extract_keywords_from_text(text)  
+        return rake_nltk_var.get_ranked_phrases()
\ No newline at end of file
@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from config import REDIS_IN_USE, get_redis_client
+
+KEYWORD_CACHE_MAX_ENTRIES = int(os.getenv("KEYWORD_CACHE_MAX_ENTRIES", 5000))
+# Longest a search waits for another process to finish fetching the same keyword.
+FETCH_LOCK_TIMEOUT = float(os.getenv("KEYWORD_CACHE_LOCK_TIMEOUT", 30))
+FETCH_POLL_INTERVAL = 0.1
+
+
+class LocalTTLCache:
+    """Bounded in-process TTL cache with single-flight loading, used when Redis is absent."""
+
+    def __init__(self, max_entries=KEYWORD_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = {}
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._items[key] = (time.monotonic() + ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def get_or_load(self, key, ttl, load, cacheable=bool):
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        # Concurrent callers for the same key queue here; only the first one loads.
+        with key_lock:
+            try:
+                value = self.get(key)
+                if value is None:
+                    value = load()
+                    if cacheable(value):
+                        self.set(key, value, ttl)
+                return value
+            finally:
+                with self._lock:
+                    # A later caller may already have installed a new lock for this key; leave it in place.
+                    if self._loading.get(key) is key_lock:
+                        del self._loading[key]
+
+
+class RedisTTLCache:
+    """Redis TTL cache shared by all backend processes.
+
+    Entry count is capped with a sorted-set LRU index, and a short-lived lock key
+    makes sure only one process loads a missing entry while the others wait for it.
+    """
+
+    def __init__(self, client, namespace, max_entries=KEYWORD_CACHE_MAX_ENTRIES):
+        self.client = client
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.index_key = f"{namespace}:lru"
+
+    def _key(self, key):
+        return f"{self.namespace}:{key}"
+
+    def get(self, key):
+        raw = self.client.get(self._key(key))
+        if raw is None:
+            return None
+        self.client.zadd(self.index_key, {key: time.time()})
+        return json.loads(raw)
+
+    def set(self, key, value, ttl):
+        pipe = self.client.pipeline()
+        pipe.set(self._key(key), json.dumps(value), ex=max(1, int(ttl)))
+        pipe.zadd(self.index_key, {key: time.time()})
+        pipe.zcard(self.index_key)
+        overflow = pipe.execute()[-1] - self.max_entries
+        if overflow > 0:
+            evicted = [member.decode() for member, _ in self.client.zpopmin(self.index_key, overflow)]
+            self.client.delete(*[self._key(member) for member in evicted])
+
+    def delete(self, key):
+        pipe = self.client.pipeline()
+        pipe.delete(self._key(key))
+        pipe.zrem(self.index_key, key)
+        pipe.execute()
+
+    def get_or_load(self, key, ttl, load, cacheable=bool):
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        lock_key = self._key(key) + ":lock"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + FETCH_LOCK_TIMEOUT
+
+        while not self.client.set(lock_key, token, nx=True, px=int(FETCH_LOCK_TIMEOUT * 1000)):
+            # Another process is loading this key; wait for its result.
+            time.sleep(FETCH_POLL_INTERVAL)
+            value = self.get(key)
+            if value is not None:
+                return value
+            if time.monotonic() > deadline:
+                logging.warning(f"Timed out waiting for cache entry '{key}', loading it directly.")
+                return load()
+
+        try:
+            value = self.get(key)
+            if value is None:
+                value = load()
+                if cacheable(value):
+                    self.set(key, value, ttl)
+            return value
+        finally:
+            if self.client.get(lock_key) == token.encode():
+                self.client.delete(lock_key)
+
+
+class LocalCounter:
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        return self._value
+
+    def bump(self):
+        with self._lock:
+            self._value += 1
+            return self._value
+
+
+class RedisCounter:
+    def __init__(self, client, key):
+        self.client = client
+        self.key = key
+
+    def get(self):
+        return int(self.client.get(self.key) or 0)
+
+    def bump(self):
+        return self.client.incr(self.key)
+
+
+def build_counter(name):
+    if REDIS_IN_USE:
+        return RedisCounter(get_redis_client(), f"version:{name}")
+    return LocalCounter()
+
+
+def build_cache(namespace):
+    if REDIS_IN_USE:
+        return RedisTTLCache(get_redis_client(), namespace)
+    return LocalTTLCache()
+
+
+keyword_cache = build_cache("keyword")
@@ -0,0 +1,36 @@
+import os
+import hashlib
+from keyword_cache import build_cache, build_counter
+from clip_client import clip_client
+
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 600))
+
+result_cache = build_cache("results")
+blacklist_version = build_counter("blacklist")
+
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+def result_cache_key(query, top_k, providers):
+    """Cache key of a whole search, or None when the model version is unknown.
+
+    The model version and blacklist version are part of the key, so changing
+    either one retires every older entry at once.
+    """
+    model_version = clip_client.model_version()
+    if model_version is None:
+        return None
+
+    provider_names = ",".join(sorted(provider.NAME for provider in providers))
+    parts = [normalize_query(query), str(top_k), provider_names, model_version, str(blacklist_version.get())]
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+def get_cached_results(cache_key):
+    if cache_key is None:
+        return None
+    return result_cache.get(cache_key)
+
+def store_results(cache_key, results):
+    if cache_key is not None and results:
+        result_cache.set(cache_key, results, RESULT_CACHE_TTL)
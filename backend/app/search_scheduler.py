@@ -0,0 +1,148 @@
+import os
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from services.blacklist_service import get_blocked_urls
+from deadline import with_current_context
+
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", 32))
+PROVIDER_CONCURRENCY = int(os.getenv("PROVIDER_CONCURRENCY", 4))
+# Share of a search's latency budget kept for scoring; fetches must finish before it starts.
+SCORING_RESERVE = float(os.getenv("SEARCH_SCORING_RESERVE", 0.25))
+
+LOCAL_PROVIDER = "local"
+LIBRARY = "library"
+
+
+def provider_name(provider):
+    if provider == LIBRARY:
+        return LIBRARY
+    return LOCAL_PROVIDER if provider is None else provider.NAME
+
+
+class SearchScheduler:
+    """Runs the keyword x provider fetch matrix of a search concurrently.
+
+    Each fetch unit is scored by CLIP as soon as it is done, while the other
+    fetches are still running, so results stream in at the pace of the fastest
+    provider. Provider concurrency is capped across all searches sharing this
+    scheduler.
+    """
+
+    def __init__(self, app, searcher, max_workers=SEARCH_WORKERS, per_provider=PROVIDER_CONCURRENCY):
+        self.app = app
+        self.searcher = searcher
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="search")
+        self._provider_limits = {
+            provider_name(provider): threading.BoundedSemaphore(per_provider)
+            for provider in searcher.api_providers
+        }
+
+    def _search_library(self, semantic_query, top_k, blocked_urls):
+        with self.app.test_request_context():
+            return self.searcher.search_library(semantic_query, top_k, blocked_urls)
+
+    def _fetch(self, keyword, provider, max_images, blocked_urls):
+        # Providers build public URLs with url_for, which needs a request context.
+        with self.app.test_request_context():
+            limit = self._provider_limits.get(provider_name(provider))
+            if limit is None:
+                return self.searcher.fetch_unit(keyword, provider, max_images, blocked_urls)
+            with limit:
+                return self.searcher.fetch_unit(keyword, provider, max_images, blocked_urls)
+
+    def _cut(self, outstanding):
+        cut = []
+        for future, (kind, keyword, provider) in outstanding.items():
+            future.cancel()
+            cut.append({"stage": kind, "tag": keyword, "provider": provider_name(provider)})
+        return cut
+
+    def run(self, keywords, semantic_query, max_images, top_k, deadline=None):
+        """Yield a "progress" event per finished unit and a "scored" event per ranked fetch unit, in completion order.
+
+        With a deadline, fetches get a shorter one so there is time left to score
+        them. Units still running when the deadline passes are cancelled or
+        abandoned and reported in a final "cut" event.
+
+        A unit that raised, or a provider fetch that came back empty, is marked
+        "failed" in its progress event: providers log and swallow their request
+        errors and return no images instead, like the keyword cache assumes.
+        """
+        with self.app.app_context():
+            blocked_urls = get_blocked_urls()
+
+        keywords = list(dict.fromkeys(keywords))
+        providers = list(self.searcher.api_providers) + [None]
+        completed = queue.Queue()
+        outstanding = {}
+        fetch_deadline = deadline.shortened(SCORING_RESERVE) if deadline else None
+
+        def submit(kind, keyword, provider, fn, *args):
+            unit_deadline = fetch_deadline if kind == "fetch" else deadline
+            future = self._executor.submit(with_current_context(fn, *args, deadline=unit_deadline))
+            outstanding[future] = (kind, keyword, provider)
+            future.add_done_callback(lambda f: completed.put((kind, keyword, provider, f)))
+
+        for keyword in keywords:
+            for provider in providers:
+                submit("fetch", keyword, provider, self._fetch, keyword, provider, max_images, blocked_urls)
+
+        # The whole query is also matched against the local library index, independent of keywords.
+        submit("score", semantic_query, LIBRARY, self._search_library, semantic_query, top_k, blocked_urls)
+
+        # Every fetch unit is followed by one scoring unit, plus the library search.
+        total = len(keywords) * len(providers) * 2 + 1
+        done = 0
+
+        while done < total:
+            try:
+                timeout = None if deadline is None else max(deadline.remaining(), 0)
+                kind, keyword, provider, future = completed.get(timeout=timeout)
+            except queue.Empty:
+                yield {"event": "cut", "data": self._cut(outstanding)}
+                return
+            outstanding.pop(future, None)
+            done += 1
+
+            failed = False
+            try:
+                result = future.result()
+            except Exception:
+                logging.exception(f"Search unit {kind} failed for keyword '{keyword}' ({provider_name(provider)})")
+                result = ([], [])
+                failed = True
+
+            if kind == "fetch":
+                clip_paths, posts_json = result
+                failed = failed or (provider is not None and not clip_paths)
+                if clip_paths and posts_json:
+                    submit("score", keyword, provider, self.searcher.rank_images, clip_paths, posts_json, semantic_query, top_k)
+                else:
+                    # Nothing to score, so its scoring unit is done too.
+                    done += 1
+
+            yield {
+                "event": "progress",
+                "data": {
+                    "current": done,
+                    "total": total,
+                    "percent": int(done / total * 100),
+                    "tag": keyword,
+                    "provider": provider_name(provider),
+                    "failed": failed,
+                },
+            }
+
+            if kind == "score":
+                top_images, top_scores = result
+                yield {
+                    "event": "scored",
+                    "data": {
+                        "tag": keyword,
+                        "provider": provider_name(provider),
+                        "images": top_images,
+                        "scores": top_scores,
+                    },
+                }
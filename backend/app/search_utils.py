@@ -1,21 +1,18 @@
 from config import UPLOAD_FOLDER, CLIP_MOUNT_PATH, build_posts_array
 import logging
-from db_connector import Keyword
+from db_connector import Keyword, Post
 import os
 from flask import current_app
-from services.blacklist_service import get_blocked_urls
+from clip_client import clip_client
 
 
 
-def fetch_images_tag(search_keyword, num_images, api_providers):
-    all_clip_paths = []
-    all_posts_json = []
+def fetch_provider_images(search_keyword, num_images, provider, blocked_urls):
+    return provider.fetch(search_keyword, num_images, blocked_urls)
 
-    blocked_urls = get_blocked_urls()
-    for provider in api_providers:
-        clip_paths, posts_json = provider.fetch(search_keyword, num_images, blocked_urls)
-        all_clip_paths.extend(clip_paths)
-        all_posts_json.extend(posts_json)
+def fetch_local_images(search_keyword):
+    clip_paths = []
+    posts_json = []
 
     logging.info(f"Searching database for keyword '{search_keyword}")
     
@@ -31,17 +28,42 @@ def fetch_images_tag(search_keyword, num_images, api_providers):
                 
                 if os.path.exists(local_path):
                     clip_path = local_path.replace(UPLOAD_FOLDER, CLIP_MOUNT_PATH, 1)
-                    all_clip_paths.append(clip_path)
+                    clip_paths.append(clip_path)
 
                     local_images.append(post)
                     db_images_count += 1
             
             logging.info(f"Fetched {db_images_count} images for keyword '{search_keyword}'.")
 
-            local_posts_json = build_posts_array(local_images)
-            
-            all_posts_json.extend(local_posts_json)
+            posts_json = build_posts_array(local_images)
         else:
             logging.info(f"No local images found for keyword '{search_keyword}'.")
 
-    return (all_clip_paths, all_posts_json)
\ No newline at end of file
+    return (clip_paths, posts_json)
+
+def search_local_library(semantic_query, top_k, excluded_folders, blocked_urls):
+    """Rank local posts straight from the CLIP vector index, independent of keyword matches."""
+    exclude_prefixes = [folder.replace(UPLOAD_FOLDER, CLIP_MOUNT_PATH, 1) for folder in excluded_folders]
+    result = clip_client.search(semantic_query, top_k, exclude_prefixes)
+
+    scores_by_path = {}
+    for source, score in zip(result["sources"], result["scores"]):
+        if source.startswith(CLIP_MOUNT_PATH):
+            scores_by_path[os.path.relpath(source, CLIP_MOUNT_PATH)] = score
+
+    if not scores_by_path:
+        return ([], [])
+
+    with current_app.app_context():
+        posts = Post.query.filter(Post.image_path.in_(list(scores_by_path))).all()
+        posts.sort(key=lambda post: scores_by_path[post.image_path], reverse=True)
+        posts_json = build_posts_array(posts)
+
+    ranked = [
+        (post_json, scores_by_path[post.image_path])
+        for post, post_json in zip(posts, posts_json)
+        if post_json["source_url"] not in blocked_urls
+    ]
+    logging.info(f"Found {len(ranked)} local library images for '{semantic_query}'.")
+
+    return ([post for post, _ in ranked], [score for _, score in ranked])
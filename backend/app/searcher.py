@@ -1,56 +1,70 @@
 import os
-import requests
-from search_utils import fetch_images_tag
-from direct_redis import DirectRedis
+from search_utils import fetch_provider_images, fetch_local_images, search_local_library
+from API_providers import PROVIDER_UPLOAD_FOLDERS
+from clip_client import clip_client, local_path_for
+from blob_store import blob_store
+from keyword_cache import keyword_cache
 import logging
 
-redis = os.getenv("REDIS_IN_USE", "false")
-redis_host = "redis"
-redis_port = 6379
-redis_client = DirectRedis(host=redis_host, port=redis_port)
 
-model_host = os.getenv("MODEL_HOST")
-model_port = os.getenv("MODEL_PORT")
+def provider_cache_ttl(provider):
+    return int(os.getenv(f"KEYWORD_CACHE_TTL_{provider.NAME.upper()}", provider.CACHE_TTL))
+
+def cached_files_exist(clip_paths):
+    return all(os.path.exists(local_path_for(path)) for path in clip_paths)
 
 
 class Searcher:
     def __init__(self, api_providers):
         self.api_providers = api_providers
 
-    def get_similar_images(self, keyword, semantic_query, max_images, top_k):
-        if redis == "true":
-            images_redis_key = keyword + "_images"
-            urls_redis_key = keyword + "_urls"
-
-            if redis_client.exists(images_redis_key) and redis_client.exists(urls_redis_key):
-                keyword_images = redis_client.get(images_redis_key)
-                keyword_image_urls = redis_client.get(urls_redis_key)
-            else:
-                (keyword_images, keyword_image_urls) = fetch_images_tag(
-                    keyword, max_images, self.api_providers
-                )
-                redis_client.set(images_redis_key, keyword_images)
-                redis_client.set(urls_redis_key, keyword_image_urls)
-        else:
-            (keyword_images, keyword_image_objects) = fetch_images_tag(keyword, max_images, self.api_providers)
-
-            if not keyword_images or not keyword_image_objects:
-                logging.warning("No images fatched - skipping CLIP similarity")
-                return
-        
-        response = requests.post(
-            f"http://{model_host}:{model_port}/similarity",
-            json={
-                "images": keyword_images,
-                "query": semantic_query,
-                "top_k": top_k
-            }
+    def fetch_unit(self, keyword, provider, max_images, blocked_urls):
+        # provider=None is the local post library, which is cheap to query and never cached.
+        if provider is None:
+            return fetch_local_images(keyword)
+
+        cache_key = f"{provider.NAME}:{max_images}:{keyword}"
+        ttl = provider_cache_ttl(provider)
+
+        def load():
+            clip_paths, posts_json = fetch_provider_images(keyword, max_images, provider, blocked_urls)
+            # The blobs must outlive the cache entry that refers to them.
+            blob_store.pin([local_path_for(path) for path in clip_paths], ttl)
+            return clip_paths, posts_json
+
+        clip_paths, posts_json = keyword_cache.get_or_load(
+            cache_key,
+            ttl,
+            load,
+            cacheable=lambda result: bool(result[0]),
         )
-        response.raise_for_status()
-        result = response.json()
+
+        if not cached_files_exist(clip_paths):
+            logging.info(f"Cached images for '{keyword}' from {provider.NAME} are gone; fetching again.")
+            keyword_cache.delete(cache_key)
+            clip_paths, posts_json = fetch_provider_images(keyword, max_images, provider, blocked_urls)
+
+        # Entries may predate a blacklist change, so blocked images are filtered on every read.
+        kept = [
+            (clip_path, post) for clip_path, post in zip(clip_paths, posts_json)
+            if post["source_url"] not in blocked_urls
+        ]
+        return ([clip_path for clip_path, _ in kept], [post for _, post in kept])
+
+    def search_library(self, semantic_query, top_k, blocked_urls):
+        return search_local_library(semantic_query, top_k, PROVIDER_UPLOAD_FOLDERS, blocked_urls)
+
+    def rank_images(self, keyword_images, keyword_image_objects, semantic_query, top_k):
+        if not keyword_images or not keyword_image_objects:
+            return ([], [])
+
+        result = clip_client.similarity(keyword_images, semantic_query, top_k)
 
         indices = result["indices"]
         scores = result["scores"]
+        # Indices refer to keyword_images; images CLIP could not load are simply not ranked.
+        if result.get("errors"):
+            logging.warning(f"CLIP could not load {len(result['errors'])} of {len(keyword_images)} images for '{semantic_query}'")
         
         top_imgs = [keyword_image_objects[i] for i in indices]
-        return (top_imgs, scores)
\ No newline at end of file
+        return (top_imgs, scores)
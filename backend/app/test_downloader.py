@@ -0,0 +1,109 @@
+import time
+import socket
+import threading
+import unittest
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from downloader import ImageDownloader
+
+RESPONSE_DELAY = 0.2
+
+
+class StubServer:
+    """Local HTTP server that records how many requests it serves at once."""
+
+    def __init__(self):
+        self.active = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub._lock:
+                    stub.active += 1
+                    stub.peak = max(stub.peak, stub.active)
+                try:
+                    time.sleep(RESPONSE_DELAY)
+                    status = 404 if self.path == "/missing" else 200
+                    body = b"image-bytes" if status == 200 else b""
+                    self.send_response(status)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                finally:
+                    with stub._lock:
+                        stub.active -= 1
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def unused_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class ImageDownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.hosts = [StubServer(), StubServer()]
+        self.downloader = ImageDownloader(max_workers=8, max_per_host=2)
+
+    def tearDown(self):
+        for host in self.hosts:
+            host.close()
+
+    def fetch(self, url):
+        return self.downloader.get(url, timeout=5).content
+
+    def test_caps_concurrent_requests_per_host(self):
+        host = self.hosts[0]
+        results = self.downloader.map(self.fetch, [f"{host.url}/{i}.jpg" for i in range(8)])
+
+        self.assertEqual(results, [b"image-bytes"] * 8)
+        self.assertEqual(host.peak, 2)
+
+    def test_hosts_do_not_share_a_limit(self):
+        urls = [f"{host.url}/{i}.jpg" for i in range(4) for host in self.hosts]
+        start = time.monotonic()
+        self.downloader.map(self.fetch, urls)
+        elapsed = time.monotonic() - start
+
+        self.assertEqual([host.peak for host in self.hosts], [2, 2])
+        # Two rounds of two per host, not four rounds if the hosts shared one limit.
+        self.assertLess(elapsed, 3.5 * RESPONSE_DELAY)
+
+    def test_failures_come_back_in_place(self):
+        host = self.hosts[0]
+        urls = [f"{host.url}/ok.jpg", f"http://127.0.0.1:{unused_port()}/down.jpg", f"{host.url}/missing"]
+
+        def fetch(url):
+            response = self.downloader.get(url, timeout=5)
+            response.raise_for_status()
+            return response.content
+
+        ok, down, missing = self.downloader.map(fetch, urls)
+
+        self.assertEqual(ok, b"image-bytes")
+        self.assertIsInstance(down, requests.ConnectionError)
+        self.assertIsInstance(missing, requests.HTTPError)
+
+    def test_failed_request_releases_its_host_slot(self):
+        host = self.hosts[0]
+        self.downloader.map(self.fetch, [f"{host.url}/missing"] * 4)
+
+        results = self.downloader.map(self.fetch, [f"{host.url}/{i}.jpg" for i in range(2)])
+        self.assertEqual(results, [b"image-bytes"] * 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
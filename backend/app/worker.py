@@ -0,0 +1,139 @@
+import os
+import time
+import logging
+import threading
+import requests
+from clip_client import clip_client
+from job_queue import build_job_queue
+
+WORKER_BATCH_SIZE = int(os.getenv("WORKER_BATCH_SIZE", 64))
+WORKER_MAX_WAIT = float(os.getenv("WORKER_MAX_WAIT", 0.5))
+WORKER_MAX_ATTEMPTS = int(os.getenv("WORKER_MAX_ATTEMPTS", 5))
+WORKER_RETRY_DELAY = float(os.getenv("WORKER_RETRY_DELAY", 2.0))
+STATS_INTERVAL = 5.0
+
+INDEX_ADD = "index_add"
+INDEX_REMOVE = "index_remove"
+
+
+class EmbeddingWorker:
+    """Consumes embedding jobs and applies them to the CLIP service in batches.
+
+    A batch is collected until WORKER_BATCH_SIZE jobs or WORKER_MAX_WAIT seconds,
+    then consecutive jobs of the same type are merged into one CLIP call, so the
+    relative order of adds and removes is kept.
+    """
+
+    def __init__(self, job_queue, client=clip_client, batch_size=WORKER_BATCH_SIZE, max_wait=WORKER_MAX_WAIT):
+        self.job_queue = job_queue
+        self.client = client
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.handlers = {
+            INDEX_ADD: lambda paths: self.client.index_add(paths),
+            INDEX_REMOVE: lambda paths: self.client.index_remove(paths),
+        }
+        self._stop = threading.Event()
+        self._started_at = time.time()
+        self._last_published = 0.0
+        self.stats = {"processed": 0, "failed": 0, "skipped": 0, "batches": 0, "jobs_per_sec": 0.0}
+
+    def stop(self):
+        self._stop.set()
+
+    def run_forever(self):
+        logging.info(f"Embedding worker started (batch size {self.batch_size}, max wait {self.max_wait}s).")
+        while not self._stop.is_set():
+            batch = self.job_queue.pop_batch(self.batch_size, self.max_wait)
+            if batch:
+                self.process(batch)
+            self._publish_stats()
+
+    def process(self, batch):
+        started = time.monotonic()
+        fresh, skipped = [], []
+        for job in batch:
+            if self.job_queue.is_done(job) or job.get("type") not in self.handlers:
+                skipped.append(job)
+            else:
+                fresh.append(job)
+        if skipped:
+            # Redelivered or unknown jobs are acknowledged without running them again.
+            self.job_queue.ack(skipped)
+            self.stats["skipped"] += len(skipped)
+
+        groups = self._consecutive_groups(fresh)
+        for n, group in enumerate(groups):
+            job_type = group[0]["type"]
+            paths = [path for job in group for path in job.get("paths", [])]
+            try:
+                self.handlers[job_type](paths)
+            except requests.RequestException as e:
+                logging.warning(f"{job_type} batch of {len(group)} jobs failed: {e}")
+                # Later groups go back too, so adds and removes are never reordered.
+                self._retry(group, [job for later in groups[n + 1:] for job in later])
+                break
+            self.job_queue.ack(group)
+            self.stats["processed"] += len(group)
+
+        self.stats["batches"] += 1
+        elapsed = max(time.monotonic() - started, 1e-6)
+        # Exponentially weighted throughput, so the figure tracks recent load.
+        self.stats["jobs_per_sec"] = 0.8 * self.stats["jobs_per_sec"] + 0.2 * (len(batch) / elapsed)
+
+    def _consecutive_groups(self, jobs):
+        groups = []
+        for job in jobs:
+            if groups and groups[-1][0]["type"] == job["type"]:
+                groups[-1].append(job)
+            else:
+                groups.append([job])
+        return groups
+
+    def _retry(self, failed, following):
+        retry = []
+        for job in failed:
+            job["attempts"] = job.get("attempts", 0) + 1
+            if job["attempts"] >= WORKER_MAX_ATTEMPTS:
+                logging.error(f"Dropping job {job['id']} after {job['attempts']} attempts.")
+                self.job_queue.ack([job])
+                self.stats["failed"] += 1
+            else:
+                retry.append(job)
+        self.job_queue.requeue(retry + following)
+        # Back off so an unavailable CLIP service is not hammered with retries.
+        self._stop.wait(WORKER_RETRY_DELAY)
+
+    def _publish_stats(self):
+        now = time.time()
+        if now - self._last_published < STATS_INTERVAL:
+            return
+        self._last_published = now
+        self.job_queue.publish_stats({
+            **self.stats,
+            "uptime": round(now - self._started_at),
+            "queue": self.job_queue.depth(),
+            "updated_at": now,
+        })
+
+
+def start_background_worker(job_queue):
+    """Run a worker thread inside the current process (used when Redis is not available)."""
+    worker = EmbeddingWorker(job_queue)
+    thread = threading.Thread(target=worker.run_forever, name="embedding-worker", daemon=True)
+    thread.start()
+    return worker
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    job_queue = build_job_queue()
+    if hasattr(job_queue, "recover"):
+        recovered = job_queue.recover()
+        if recovered:
+            logging.info(f"Recovered {recovered} unacknowledged jobs.")
+    EmbeddingWorker(job_queue).run_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import os
+import hashlib
+import logging
+import torch
+
+# "eager" (default), "int8" (dynamically quantized linear layers), "torchscript" or "onnx".
+CLIP_BACKEND = os.getenv("CLIP_BACKEND", "eager")
+# Intra-op threads for torch and ONNX Runtime; 0 keeps the library default.
+CLIP_NUM_THREADS = int(os.getenv("CLIP_NUM_THREADS", 0))
+EXPORT_DIR = os.getenv("CLIP_EXPORT_DIR", "/app/cache/exports")
+# Exported text graphs take fixed-length input; CLIP's context length is 77 tokens.
+TEXT_LENGTH = 77
+ONNX_OPSET = 17
+
+
+class ImageEncoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model.get_image_features(pixel_values=pixel_values)
+
+
+class TextEncoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+
+
+class EagerBackend:
+    name = "eager"
+    # Tokenizer padding the backend needs; exported graphs want a fixed sequence length.
+    text_padding = {"padding": True}
+
+    def __init__(self, model):
+        self.model = model
+
+    def image_features(self, pixel_values):
+        with torch.no_grad():
+            return self.model.get_image_features(pixel_values=pixel_values)
+
+    def text_features(self, input_ids, attention_mask):
+        with torch.no_grad():
+            return self.model.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+
+
+class Int8Backend(EagerBackend):
+    name = "int8"
+
+    def __init__(self, model):
+        # Quantizing takes seconds and its result cannot be loaded without re-quantizing, so it is not exported.
+        # In place, so the float linear weights are released instead of kept alongside the int8 ones;
+        # ClipModel.model is the quantized model afterwards.
+        super().__init__(torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True))
+
+
+class TorchScriptBackend:
+    name = "torchscript"
+    text_padding = {"padding": "max_length", "max_length": TEXT_LENGTH, "truncation": True}
+
+    def __init__(self, model, export_dir):
+        image_path = os.path.join(export_dir, "image.pt")
+        text_path = os.path.join(export_dir, "text.pt")
+        if not (os.path.isfile(image_path) and os.path.isfile(text_path)):
+            logging.info(f"Tracing TorchScript graphs into {export_dir}")
+            image_input, text_inputs = example_inputs(model)
+            with torch.no_grad():
+                _save_atomic(torch.jit.trace(ImageEncoder(model), image_input), image_path, torch.jit.save)
+                _save_atomic(torch.jit.trace(TextEncoder(model), text_inputs), text_path, torch.jit.save)
+
+        self.image_encoder = torch.jit.optimize_for_inference(torch.jit.load(image_path).eval())
+        self.text_encoder = torch.jit.optimize_for_inference(torch.jit.load(text_path).eval())
+
+    def image_features(self, pixel_values):
+        with torch.no_grad():
+            return self.image_encoder(pixel_values)
+
+    def text_features(self, input_ids, attention_mask):
+        with torch.no_grad():
+            return self.text_encoder(input_ids, attention_mask)
+
+
+class OnnxBackend:
+    name = "onnx"
+    text_padding = TorchScriptBackend.text_padding
+
+    def __init__(self, model, export_dir):
+        import onnxruntime
+
+        image_path = os.path.join(export_dir, "image.onnx")
+        text_path = os.path.join(export_dir, "text.onnx")
+        if not (os.path.isfile(image_path) and os.path.isfile(text_path)):
+            logging.info(f"Exporting ONNX graphs into {export_dir}")
+            image_input, text_inputs = example_inputs(model)
+            with torch.no_grad():
+                _save_atomic(ImageEncoder(model), image_path, lambda module, path: torch.onnx.export(
+                    module, (image_input,), path, dynamo=False, opset_version=ONNX_OPSET,
+                    input_names=["pixel_values"], output_names=["features"],
+                    dynamic_axes={"pixel_values": {0: "batch"}, "features": {0: "batch"}},
+                ))
+                _save_atomic(TextEncoder(model), text_path, lambda module, path: torch.onnx.export(
+                    module, text_inputs, path, dynamo=False, opset_version=ONNX_OPSET,
+                    input_names=["input_ids", "attention_mask"], output_names=["features"],
+                    dynamic_axes={"input_ids": {0: "batch"}, "attention_mask": {0: "batch"}, "features": {0: "batch"}},
+                ))
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if CLIP_NUM_THREADS:
+            options.intra_op_num_threads = CLIP_NUM_THREADS
+        self.image_session = onnxruntime.InferenceSession(image_path, options, providers=["CPUExecutionProvider"])
+        self.text_session = onnxruntime.InferenceSession(text_path, options, providers=["CPUExecutionProvider"])
+
+    def image_features(self, pixel_values):
+        features, = self.image_session.run(None, {"pixel_values": pixel_values.numpy()})
+        return torch.from_numpy(features)
+
+    def text_features(self, input_ids, attention_mask):
+        features, = self.text_session.run(None, {
+            "input_ids": input_ids.numpy(),
+            "attention_mask": attention_mask.numpy(),
+        })
+        return torch.from_numpy(features)
+
+
+def example_inputs(model):
+    image_size = model.config.vision_config.image_size
+    pixel_values = torch.zeros(2, 3, image_size, image_size)
+    input_ids = torch.zeros(2, TEXT_LENGTH, dtype=torch.long)
+    attention_mask = torch.ones(2, TEXT_LENGTH, dtype=torch.long)
+    return pixel_values, (input_ids, attention_mask)
+
+
+def _save_atomic(obj, path, save):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def export_key(model_path, backend):
+    """Export cache key: model path, the local adapter/model files, the backend and the torch version.
+
+    Config files are hashed; weight files only contribute name, size and mtime, so
+    computing the key never reads the weights on boot.
+    """
+    digest = hashlib.sha256(f"{model_path}|{backend}|{torch.__version__}".encode())
+    if os.path.isdir(model_path):
+        for fname in sorted(os.listdir(model_path)):
+            path = os.path.join(model_path, fname)
+            if not os.path.isfile(path):
+                continue
+            if fname.endswith(".json"):
+                digest.update(fname.encode())
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+            elif fname.endswith((".safetensors", ".bin")):
+                stat = os.stat(path)
+                digest.update(f"{fname}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()[:16]
+
+
+def load_backend(model, model_path, backend=CLIP_BACKEND):
+    if CLIP_NUM_THREADS:
+        torch.set_num_threads(CLIP_NUM_THREADS)
+
+    model.eval()
+    if backend == "eager":
+        return EagerBackend(model)
+    if backend == "int8":
+        return Int8Backend(model)
+
+    export_dir = os.path.join(EXPORT_DIR, export_key(model_path, backend))
+    if backend == "torchscript":
+        return TorchScriptBackend(model, export_dir)
+    if backend == "onnx":
+        return OnnxBackend(model, export_dir)
+    raise ValueError(f"Unknown CLIP_BACKEND '{backend}'")
@@ -0,0 +1,84 @@
+import os
+import time
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from model import ClipModel
+from batcher import MicroBatcher
+from image_io import load_image
+
+# Throughput vs. added latency of cross-request micro-batching.
+# Each simulated request embeds IMAGES_PER_REQUEST images; CONCURRENCY requests run at once.
+# Usage: python batch_benchmark.py (optionally with CLIP_BATCH_MAX_SIZE / CLIP_BATCH_MAX_WAIT_MS set)
+# BENCH_IMAGES_DIR points at any folder of images; the default is the repo's resources/, which is
+# not copied into the container.
+#
+# Sample run: ViT-B/32 (random weights, same compute), eager backend, 1 CPU core, torch 2.x,
+# 4 images per request, BENCH_REQUESTS=32 (default 64), max batch 64, max wait 5 ms:
+#
+#   concurrency |     mode |  images/s |   p50 ms |   p95 ms
+#             1 |   direct |       9.2 |    447.2 |    478.0
+#             1 |  batched |       9.0 |    448.2 |    527.4
+#             2 |   direct |       8.0 |    966.7 |   1113.9
+#             2 |  batched |       9.6 |    838.4 |    899.5
+#             4 |   direct |       9.1 |   1763.3 |   1935.0
+#             4 |  batched |      10.8 |   1449.3 |   1759.0
+#             8 |   direct |       9.4 |   3355.0 |   3855.1
+#             8 |  batched |      10.9 |   2864.5 |   3312.1
+#            16 |   direct |       8.8 |   6825.3 |   8743.8
+#            16 |  batched |       9.8 |   6510.2 |   6541.3
+#
+# Without concurrency batching costs up to the max wait; from 2 concurrent requests on it
+# raises throughput by 10-20% and lowers p50 and p95.
+
+RESOURCES = os.getenv("BENCH_IMAGES_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "resources"))
+IMAGES_PER_REQUEST = int(os.getenv("BENCH_IMAGES_PER_REQUEST", 4))
+REQUESTS = int(os.getenv("BENCH_REQUESTS", 64))
+CONCURRENCY = [1, 2, 4, 8, 16]
+
+clip_model = ClipModel(os.getenv("CLIP_MODEL_PATH", "openai/clip-vit-base-patch32"))
+batcher = MicroBatcher(clip_model.get_image_embeddings, "bench")
+
+images = [
+    load_image(os.path.join(RESOURCES, fname))
+    for fname in sorted(os.listdir(RESOURCES))
+    if fname.lower().endswith((".jpg", ".jpeg", ".png"))
+]
+request_images = [images[i % len(images)] for i in range(IMAGES_PER_REQUEST)]
+
+# Warm-up, so the first measured pass does not pay for lazy initialisation.
+clip_model.get_image_embeddings(request_images)
+
+
+def run(embed, concurrency):
+    latencies = []
+
+    def one_request():
+        start = time.perf_counter()
+        embed(request_images)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(one_request) for _ in range(REQUESTS)]
+        # Re-raises the first failed request instead of silently measuring fewer of them.
+        for future in futures:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return (
+        REQUESTS * IMAGES_PER_REQUEST / elapsed,
+        statistics.median(latencies) * 1000,
+        latencies[int(len(latencies) * 0.95) - 1] * 1000,
+    )
+
+
+print(f"{IMAGES_PER_REQUEST} images per request, {REQUESTS} requests, "
+      f"max batch {batcher.max_batch_size}, max wait {batcher.max_wait * 1000:.1f} ms")
+print(f"{'concurrency':>11} | {'mode':>8} | {'images/s':>9} | {'p50 ms':>8} | {'p95 ms':>8}")
+for concurrency in CONCURRENCY:
+    for mode, embed in (("direct", clip_model.get_image_embeddings), ("batched", batcher)):
+        throughput, p50, p95 = run(embed, concurrency)
+        print(f"{concurrency:>11} | {mode:>8} | {throughput:>9.1f} | {p50:>8.1f} | {p95:>8.1f}")
+
+print("batcher stats:", batcher.stats())
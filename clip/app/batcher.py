@@ -0,0 +1,121 @@
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+
+BATCH_MAX_SIZE = int(os.getenv("CLIP_BATCH_MAX_SIZE", 64))
+BATCH_MAX_WAIT = float(os.getenv("CLIP_BATCH_MAX_WAIT_MS", 5)) / 1000
+
+
+class MicroBatcher:
+    """Coalesces work submitted by concurrent requests into shared forward passes.
+
+    A dispatcher thread takes the first waiting request, then keeps collecting
+    requests until the next one would exceed max_batch_size items or max_wait has
+    passed, runs fn once over all of them and hands each request its slice through
+    a future. A request that does not fit starts the next batch; requests are never
+    split, so one larger than max_batch_size runs on its own.
+    """
+
+    def __init__(self, fn, name, max_batch_size=BATCH_MAX_SIZE, max_wait=BATCH_MAX_WAIT):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        # A request taken off the queue that did not fit the previous batch; only the dispatcher touches it.
+        self._carried = None
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.requests = 0
+        threading.Thread(target=self._run, name=f"{name}-batcher", daemon=True).start()
+
+    def submit(self, items):
+        future = Future()
+        if not items:
+            future.set_result(self.fn(items))
+        else:
+            self._queue.put((list(items), future))
+        return future
+
+    def __call__(self, items):
+        return self.submit(items).result()
+
+    def _collect(self):
+        first, self._carried = self._carried, None
+        pending = [first or self._queue.get()]
+        size = len(pending[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if size + len(request[0]) > self.max_batch_size:
+                self._carried = request
+                break
+            pending.append(request)
+            size += len(request[0])
+        return pending
+
+    def _run(self):
+        while True:
+            pending = self._collect()
+            items = [item for request_items, _ in pending for item in request_items]
+            try:
+                results = self.fn(items)
+            except Exception as e:
+                logging.exception(f"Batched inference over {len(items)} items failed")
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+
+            offset = 0
+            for request_items, future in pending:
+                future.set_result(results[offset:offset + len(request_items)])
+                offset += len(request_items)
+
+            with self._stats_lock:
+                self.batches += 1
+                self.items += len(items)
+                self.requests += len(pending)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "batches": self.batches,
+                "requests": self.requests,
+                "items": self.items,
+                "mean_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+            }
+
+
+class BatchedClipModel:
+    """ClipModel whose image and text embedding calls go through shared micro-batchers."""
+
+    def __init__(self, clip_model):
+        self.clip_model = clip_model
+        self.image_batcher = MicroBatcher(clip_model.get_image_embeddings, "image")
+        self.text_batcher = MicroBatcher(clip_model.compute_text_embeddings, "text")
+
+    def __getattr__(self, name):
+        return getattr(self.clip_model, name)
+
+    def get_image_embeddings(self, images):
+        return self.image_batcher(images)
+
+    def compute_text_embeddings(self, texts):
+        return self.text_batcher(texts)
+
+    def compute_text_embedding(self, text):
+        return self.compute_text_embeddings([text])
+
+    def stats(self):
+        return {"image": self.image_batcher.stats(), "text": self.text_batcher.stats()}
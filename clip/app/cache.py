@@ -1,36 +1,189 @@
 import hashlib
+import asyncio
 import torch
-from io import BytesIO
-from PIL import Image
-import base64
 import os
-import io
-from db_connector import get_embedding_by_hash, save_embedding
-from model import ClipModel
-import numpy as np
-
-def compute_hash_from_image(image: Image.Image) -> str:
-    buf = io.BytesIO()
-    image.save(buf, format="PNG")
-    return hashlib.sha256(buf.getvalue()).hexdigest()
-
-def get_or_create_embedding(image: Image.Image, clip_model):
-    # print("CACHE: IMAGE INPUT TYPE:", type(image))
-    # print("CACHE: PROCESSOR INPUT SHAPE:", np.array(image).shape)
-    img_hash = compute_hash_from_image(image)
-    cached = get_embedding_by_hash(img_hash)
-    if cached is not None:
-        print("CACHE: IM GETTING EMBEDDING FROM CACHE")
-        t = torch.tensor(cached, dtype=torch.float32)
-        if t.ndim == 1:
-            t = t.unsqueeze(0)
-        return t
-
-    inputs = clip_model.processor(images=image, return_tensors="pt")
-    with torch.no_grad():
-        emb = clip_model.model.get_image_features(**inputs)
-    
-    emb = emb / emb.norm(dim=-1, keepdim=True)
-
-    save_embedding(img_hash, emb.squeeze(0).tolist())
-    return emb
\ No newline at end of file
+from db_connector import get_embeddings_by_hashes, save_embeddings, get_file_hashes, save_file_hashes
+from image_io import read_image_bytes, read_image_bytes_async, decode_image
+from executors import run_blocking, map_settled
+from vector_index import vector_index, IVF_MIN_SIZE
+
+# "sha256" (default) or "xxh3" for a much cheaper non-cryptographic key.
+# The algorithm is part of the key, so switching it never mixes up entries.
+HASH_ALGORITHM = os.getenv("CLIP_CACHE_HASH", "sha256")
+
+def compute_hash_from_bytes(image_bytes: bytes) -> str:
+    if HASH_ALGORITHM == "xxh3":
+        import xxhash
+        return "xxh3:" + xxhash.xxh3_128_hexdigest(image_bytes)
+    return "sha256:" + hashlib.sha256(image_bytes).hexdigest()
+
+def lookup_indexed_keys(image_sources: list):
+    """Cache key per source from the file index, or None where the bytes have to be read and hashed.
+
+    Local files whose path, mtime and size match the file index are keyed without being read.
+    """
+    file_stats = {}
+    for i, source in enumerate(image_sources):
+        if os.path.isfile(source):
+            stat = os.stat(source)
+            file_stats[i] = (source, stat.st_mtime_ns, stat.st_size)
+
+    indexed = get_file_hashes(list(file_stats.values()))
+    keys = [
+        indexed.get(source) if i in file_stats else None
+        for i, source in enumerate(image_sources)
+    ]
+    return keys, file_stats
+
+def complete_image_keys(keys: list, file_stats: dict, payloads: list):
+    """Hash the payloads of sources the file index did not know, and remember local files for next time.
+
+    Sources that could not be read keep None as their key.
+    """
+    keys = list(keys)
+    new_entries = []
+    for i, key in enumerate(keys):
+        if key is None and payloads[i] is not None:
+            keys[i] = compute_hash_from_bytes(payloads[i])
+            if i in file_stats:
+                new_entries.append((*file_stats[i], keys[i]))
+
+    save_file_hashes(new_entries)
+    return keys
+
+def _scatter_reads(count: int, unread: list, results: list):
+    """Place read results back at their source index; failed reads become errors."""
+    payloads = [None] * count
+    errors = {}
+    for i, result in zip(unread, results):
+        if isinstance(result, Exception):
+            errors[i] = str(result)
+        else:
+            payloads[i] = result
+    return payloads, errors
+
+def get_or_create_embeddings(image_sources: list, clip_model, index: bool = False):
+    """Embeddings for image_sources plus {index: message} for the images that could not be read or decoded.
+
+    Failed images get a zero row, so indices still refer to image_sources. With index=True
+    the files are also added to the vector index, which only holds the local library.
+    """
+    keys, file_stats = lookup_indexed_keys(image_sources)
+    unread = [i for i, key in enumerate(keys) if key is None]
+    read = map_settled(read_image_bytes, [image_sources[i] for i in unread])
+    payloads, errors = _scatter_reads(len(image_sources), unread, read)
+    return _embed_sources(image_sources, keys, file_stats, payloads, errors, clip_model, index)
+
+async def get_or_create_embeddings_async(image_sources: list, clip_model, http_client):
+    """get_or_create_embeddings for the event loop.
+
+    Unindexed sources are read or downloaded concurrently without blocking the
+    loop, while SQLite, decoding and inference run on the executors.
+    """
+    keys, file_stats = await run_blocking(lookup_indexed_keys, image_sources)
+
+    unread = [i for i, key in enumerate(keys) if key is None]
+    read = await asyncio.gather(
+        *(read_image_bytes_async(image_sources[i], http_client) for i in unread),
+        return_exceptions=True,
+    )
+    payloads, errors = _scatter_reads(len(image_sources), unread, read)
+
+    return await run_blocking(_embed_sources, image_sources, keys, file_stats, payloads, errors, clip_model)
+
+def _embed_sources(image_sources: list, keys: list, file_stats: dict, payloads: list, errors: dict, clip_model, index: bool = False):
+    hashes = complete_image_keys(keys, file_stats, payloads)
+
+    def load_bytes(i):
+        return payloads[i] if payloads[i] is not None else read_image_bytes(image_sources[i])
+
+    # Only files on disk are indexed; URLs and inline payloads have no stable identity.
+    index_sources = [source if os.path.isfile(source) else None for source in image_sources] if index else None
+    return _get_or_create(hashes, load_bytes, clip_model, index_sources, errors)
+
+def get_or_create_embeddings_by_keys(keys: list, uploads: dict, clip_model):
+    """Embed images the client identified by cache key; only keys missing from the cache need an upload.
+
+    Uploads are hashed again here, and one that does not match its key is reported as an
+    error instead of being cached, so a client can never attach an embedding to the wrong key.
+    """
+    def load_bytes(i):
+        if keys[i] not in uploads:
+            raise ValueError(f"Image {keys[i]} is neither cached nor uploaded")
+        image_bytes = uploads[keys[i]]
+        if compute_hash_from_bytes(image_bytes) != keys[i]:
+            raise ValueError(f"Uploaded image does not match its key {keys[i]}")
+        return image_bytes
+
+    return _get_or_create(keys, load_bytes, clip_model)
+
+def get_missing_keys(keys: list):
+    cached = get_embeddings_by_hashes(keys)
+    return [key for key in dict.fromkeys(keys) if key not in cached]
+
+def _get_or_create(hashes: list, load_bytes, clip_model, index_sources: list = None, errors: dict = None):
+    errors = dict(errors or {})
+    embeddings = [None] * len(hashes)
+
+    # Cache misses are grouped by hash so duplicates in one request are embedded once.
+    cached_embeddings = get_embeddings_by_hashes([h for h in hashes if h is not None])
+    misses = {}
+    for i, img_hash in enumerate(hashes):
+        if i in errors:
+            continue
+        cached = cached_embeddings.get(img_hash)
+        if cached is not None:
+            embeddings[i] = torch.tensor(cached, dtype=torch.float32).reshape(-1)
+        else:
+            misses.setdefault(img_hash, []).append(i)
+
+    if misses:
+        # Misses are read and decoded in parallel; an image that fails is reported, not fatal.
+        decoded = map_settled(lambda img_hash: decode_image(load_bytes(misses[img_hash][0])), list(misses))
+        miss_hashes = []
+        miss_images = []
+        for img_hash, image in zip(misses, decoded):
+            if isinstance(image, Exception):
+                for i in misses[img_hash]:
+                    errors[i] = str(image)
+            else:
+                miss_hashes.append(img_hash)
+                miss_images.append(image)
+
+        if miss_images:
+            new_embs = clip_model.get_image_embeddings(miss_images)
+
+            for img_hash, emb in zip(miss_hashes, new_embs):
+                for i in misses[img_hash]:
+                    embeddings[i] = emb
+
+            save_embeddings({h: emb.numpy() for h, emb in zip(miss_hashes, new_embs)})
+
+    if not embeddings:
+        return torch.empty(0, 0), errors
+
+    if errors:
+        dim = clip_model.model.config.projection_dim
+        embeddings = [torch.zeros(dim) if emb is None else emb for emb in embeddings]
+        if index_sources:
+            index_sources = [None if i in errors else source for i, source in enumerate(index_sources)]
+
+    embeddings = torch.stack(embeddings)
+    if index_sources:
+        vector_index.add(index_sources, hashes, embeddings.numpy())
+    return embeddings, errors
+
+def rebuild_index(exclude_prefixes=()):
+    """Compact the vector index from its own entries, then re-partition it.
+
+    Drops removed rows, files that no longer exist and sources under exclude_prefixes.
+    Returns the number of rows dropped, or None if another process is already rebuilding.
+    """
+    exclude_prefixes = tuple(exclude_prefixes)
+    with vector_index.rebuild_lock() as acquired:
+        if not acquired:
+            return None
+        removed = vector_index.compact(lambda source: os.path.isfile(source) and not source.startswith(exclude_prefixes))
+        if len(vector_index) >= IVF_MIN_SIZE:
+            vector_index.train()
+        return removed
@@ -1,40 +1,160 @@
 import sqlite3
 import numpy as np
 import os
+import threading
+from collections import OrderedDict
+from utils import batch
 
 DB_PATH = "/app/cache/embeddings_cache.db"
+LRU_SIZE = int(os.getenv("CLIP_EMBEDDING_LRU_SIZE", 20000))
+
+# SQLite caps the number of bound parameters per statement.
+SQL_MAX_PARAMS = 500
+
+
+class EmbeddingLRU:
+    def __init__(self, max_size=LRU_SIZE):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            for key in keys:
+                value = self._items.get(key)
+                if value is not None:
+                    self._items.move_to_end(key)
+                    found[key] = value
+        return found
+
+    def put_many(self, items):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            for key, value in items.items():
+                self._items[key] = value
+                self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+class EmbeddingStore:
+    """SQLite embedding cache with one long-lived connection per thread and an in-process LRU."""
+
+    def __init__(self, db_path=DB_PATH, lru_size=LRU_SIZE):
+        self.db_path = db_path
+        self.lru = EmbeddingLRU(lru_size)
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def init_db(self):
+        conn = self._connection()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS image_embeddings (
+                image_hash TEXT PRIMARY KEY,
+                embedding BLOB
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS file_index (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER,
+                size INTEGER,
+                image_hash TEXT
+            )
+        """)
+        conn.commit()
+
+    def get_many(self, image_hashes):
+        keys = list(dict.fromkeys(image_hashes))
+        found = self.lru.get_many(keys)
+        missing = [key for key in keys if key not in found]
+
+        from_db = {}
+        conn = self._connection()
+        for chunk in batch(missing, SQL_MAX_PARAMS):
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT image_hash, embedding FROM image_embeddings WHERE image_hash IN ({placeholders})",
+                chunk,
+            ).fetchall()
+            for image_hash, emb_bytes in rows:
+                from_db[image_hash] = np.frombuffer(emb_bytes, dtype=np.float32)
+
+        self.lru.put_many(from_db)
+        found.update(from_db)
+        return found
+
+    def save_many(self, embeddings):
+        if not embeddings:
+            return
+        arrays = {
+            image_hash: np.asarray(embedding, dtype=np.float32)
+            for image_hash, embedding in embeddings.items()
+        }
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO image_embeddings (image_hash, embedding) VALUES (?, ?)",
+                [(image_hash, emb.tobytes()) for image_hash, emb in arrays.items()],
+            )
+        self.lru.put_many(arrays)
+
+    def get_file_hashes(self, file_stats):
+        """Map each (path, mtime_ns, size) whose index entry is still current to its image hash."""
+        expected = {path: (mtime_ns, size) for path, mtime_ns, size in file_stats}
+        found = {}
+        conn = self._connection()
+        for chunk in batch(list(expected), SQL_MAX_PARAMS):
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT path, mtime_ns, size, image_hash FROM file_index WHERE path IN ({placeholders})",
+                chunk,
+            ).fetchall()
+            for path, mtime_ns, size, image_hash in rows:
+                if expected[path] == (mtime_ns, size):
+                    found[path] = image_hash
+        return found
+
+    def save_file_hashes(self, entries):
+        if not entries:
+            return
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO file_index (path, mtime_ns, size, image_hash) VALUES (?, ?, ?, ?)",
+                entries,
+            )
+
+
+embedding_store = EmbeddingStore()
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS image_embeddings (
-            image_hash TEXT PRIMARY KEY,
-            embedding BLOB
-        )
-    """)
-    conn.commit()
-    conn.close()
+    embedding_store.init_db()
+
+def save_embeddings(embeddings: dict):
+    embedding_store.save_many(embeddings)
+
+def get_embeddings_by_hashes(image_hashes: list):
+    return embedding_store.get_many(image_hashes)
 
 def save_embedding(image_hash: str, embedding: list):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    emb_array = np.array(embedding, dtype=np.float32)
-    c.execute("INSERT OR REPLACE INTO image_embeddings (image_hash, embedding) VALUES (?, ?)",
-              (image_hash, emb_array.tobytes()))
-    conn.commit()
-    conn.close()
+    save_embeddings({image_hash: embedding})
 
 def get_embedding_by_hash(image_hash: str):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT embedding FROM image_embeddings WHERE image_hash = ?", (image_hash,))
-    row = c.fetchone()
-    conn.close()
-
-    if row is None:
-        return None
-
-    emb_bytes = row[0]
-    emb_array = np.frombuffer(emb_bytes, dtype=np.float32)
-    return emb_array
\ No newline at end of file
+    return get_embeddings_by_hashes([image_hash]).get(image_hash)
+
+def get_file_hashes(file_stats: list):
+    return embedding_store.get_file_hashes(file_stats)
+
+def save_file_hashes(entries: list):
+    embedding_store.save_file_hashes(entries)
@@ -0,0 +1,37 @@
+import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# Decoding, SQLite and torch work run here instead of on the event loop. With
+# micro-batching on, forward passes are serialized in the batcher threads, so these
+# workers mostly decode and wait; without it keep this close to 2, since torch
+# already uses several cores per forward pass.
+INFERENCE_WORKERS = int(os.getenv("CLIP_INFERENCE_WORKERS", 4))
+
+# Reading and decoding images. PIL releases the GIL while decoding, so threads use every core.
+DECODE_WORKERS = int(os.getenv("CLIP_DECODE_WORKERS", os.cpu_count() or 4))
+
+inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+decode_executor = ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="decode")
+
+
+async def run_blocking(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(inference_executor, functools.partial(fn, *args, **kwargs))
+
+
+def map_settled(fn, items):
+    """fn over items on the decode pool, in order.
+
+    Like asyncio.gather(return_exceptions=True), an item that fails yields its
+    exception in place of a result instead of failing the whole call.
+    """
+    futures = [decode_executor.submit(fn, item) for item in items]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(e)
+    return results
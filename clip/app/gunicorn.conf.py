@@ -0,0 +1,36 @@
+import os
+
+# Multi-process serving: gunicorn loads the model weights once, then forks CLIP_WORKERS
+# uvicorn workers that share them copy-on-write. Each worker has its own GIL, event
+# loop, micro-batchers and torch thread pool; the embedding cache (SQLite WAL) and the
+# vector index (file-locked writes) are shared through /app/cache.
+# Usage: gunicorn service:app -c gunicorn.conf.py
+
+bind = "0.0.0.0:4000"
+workers = int(os.getenv("CLIP_WORKERS", 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+# Import the app in the master too, so workers also share the imported modules.
+preload_app = True
+# Workers load the vector index and build their backend before they answer heartbeats.
+timeout = int(os.getenv("CLIP_WORKER_TIMEOUT", 300))
+
+# Unless set explicitly, the cores are split between workers instead of every worker
+# sizing its torch, decode, preprocessing and inference pools for the whole machine.
+threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+os.environ.setdefault("CLIP_NUM_THREADS", str(threads_per_worker))
+os.environ.setdefault("CLIP_DECODE_WORKERS", str(threads_per_worker))
+os.environ.setdefault("CLIP_PREPROCESS_WORKERS", str(threads_per_worker))
+# Never more than the single-process default of 4 (executors.py).
+os.environ.setdefault("CLIP_INFERENCE_WORKERS", str(min(4, threads_per_worker)))
+
+
+def on_starting(server):
+    # No inference runs here: torch and ONNX Runtime thread pools are not fork-safe,
+    # so backends and warm-up are set up in each worker (service.load_model).
+    from model import preload
+
+    try:
+        preload()
+    except Exception:
+        # Workers retry on their own and report the error on /ready.
+        server.log.exception("Preloading the CLIP model failed")
@@ -0,0 +1,59 @@
+import os
+import io
+import base64
+import anyio
+import requests
+from PIL import Image
+
+# JPEGs are decoded at the smallest DCT scale that still covers this size (0 disables it);
+# CLIP only sees 224x224 pixels, so full-resolution decodes are wasted work.
+DECODE_DRAFT_SIZE = int(os.getenv("CLIP_DECODE_DRAFT_SIZE", 224))
+
+
+def read_image_bytes(image_source: str) -> bytes:
+    if os.path.exists(image_source):
+        with open(image_source, "rb") as f:
+            return f.read()
+
+    if image_source.startswith("http"):
+        try:
+            response = requests.get(image_source, timeout=10)
+            response.raise_for_status()
+            return response.content
+        except Exception as e:
+            raise ValueError(f"Error occured during download of image from URL {image_source}: {e}")
+
+    try:
+        return base64.b64decode(image_source)
+    except Exception as e:
+        raise ValueError(f"False image data: {e}")
+
+async def read_image_bytes_async(image_source: str, http_client) -> bytes:
+    """read_image_bytes without blocking the event loop: files are read on worker threads, URLs fetched with httpx."""
+    if os.path.exists(image_source):
+        return await anyio.Path(image_source).read_bytes()
+
+    if image_source.startswith("http"):
+        try:
+            response = await http_client.get(image_source, timeout=10)
+            response.raise_for_status()
+            return response.content
+        except Exception as e:
+            raise ValueError(f"Error occured during download of image from URL {image_source}: {e}")
+
+    try:
+        return base64.b64decode(image_source)
+    except Exception as e:
+        raise ValueError(f"False image data: {e}")
+
+def decode_image(image_bytes: bytes) -> Image.Image:
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        if DECODE_DRAFT_SIZE and image.format == "JPEG":
+            image.draft("RGB", (DECODE_DRAFT_SIZE, DECODE_DRAFT_SIZE))
+        return image.convert("RGB")
+    except Exception as e:
+        raise ValueError(f"False image data: {e}")
+
+def load_image(image_source: str) -> Image.Image:
+    return decode_image(read_image_bytes(image_source))
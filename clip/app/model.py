@@ -1,41 +1,177 @@
 import os
-from transformers import CLIPProcessor, CLIPModel
+import shutil
 import torch
 from PIL import Image
 import time
-import pickle
-from torchvision.transforms import Resize, CenterCrop, Normalize, ToTensor
-from peft import LoraConfig, get_peft_model, PeftModel, PeftConfig
+import threading
+import multiprocessing
+from collections import OrderedDict
+from utils import batch
+from backends import CLIP_BACKEND, load_backend, export_key
+from preprocess import ImagePreprocessor
 
+# transformers, peft and pickle are imported where they are used; they are slow to
+# import and peft is only needed the first time a LoRA adapter is merged.
 
-class ClipModel:
-    def __init__(self, model_path="openai/clip-vit-base-patch32"):
-        # self.model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-        # self.processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32", use_fast=True)
-        # self.model = CLIPModel.from_pretrained(model_path)
-        # self.processor = CLIPProcessor.from_pretrained(model_path, use_fast=True)
+MODEL_PATH = os.getenv("CLIP_MODEL_PATH", "openai/clip-vit-base-patch32")
+IMAGE_BATCH_SIZE = int(os.getenv("CLIP_IMAGE_BATCH_SIZE", 32))
+TEXT_CACHE_SIZE = int(os.getenv("CLIP_TEXT_CACHE_SIZE", 4096))
+# Loaded models are saved here once, LoRA adapters already merged, as memory-mapped safetensors.
+SNAPSHOT_DIR = os.getenv("CLIP_SNAPSHOT_DIR", "/app/cache/snapshots")
+USE_SNAPSHOT = os.getenv("CLIP_USE_SNAPSHOT", "true") == "true"
+# Batch image preprocessing in preprocess.py instead of the HF image processor.
+FAST_PREPROCESS = os.getenv("CLIP_FAST_PREPROCESS", "true") == "true"
+
+
+def normalize_query(text):
+    # The CLIP tokenizer lowercases and collapses whitespace itself, so this never changes the embedding.
+    return " ".join(text.lower().split())
+
+
+class TextEmbeddingCache:
+    def __init__(self, max_size=TEXT_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            emb = self._items.get(key)
+            if emb is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._items.move_to_end(key)
+            return emb
+
+    def put(self, key, emb):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[key] = emb
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._items),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def load_clip(model_path):
+    """Load the CLIP model and processor, merging the LoRA adapter if model_path holds one.
+
+    The result is saved as a snapshot on first load, so later boots skip both the
+    hub lookup and the adapter merge and memory-map the weights instead.
+    """
+    from transformers import CLIPProcessor, CLIPModel
+
+    is_lora = is_lora_adapter(model_path)
+    snapshot_dir = snapshot_dir_for(model_path)
+
+    if has_snapshot(model_path):
+        print(">> Loading model snapshot:", snapshot_dir)
+        model = CLIPModel.from_pretrained(snapshot_dir)
+        processor = CLIPProcessor.from_pretrained(snapshot_dir, use_fast=not is_lora)
+        return model, processor
+
+    if is_lora:
+        from peft import PeftModel, PeftConfig
+
+        print(">> Loading LoRA adapter:", model_path)
+
+        config = PeftConfig.from_pretrained(model_path)
+
+        base_model_name = config.base_model_name_or_path
+        print(">> Base CLIP model:", base_model_name)
+
+        model = CLIPModel.from_pretrained(base_model_name)
+
+        model = PeftModel.from_pretrained(model, model_path)
+
+        model = model.merge_and_unload()
+
+        processor = CLIPProcessor.from_pretrained(base_model_name)
+    else:
+        print(">> Loading base CLIP model:", model_path)
+        model = CLIPModel.from_pretrained(model_path)
+        processor = CLIPProcessor.from_pretrained(model_path, use_fast=True)
+
+    if snapshot_dir:
+        save_snapshot(model, processor, snapshot_dir)
+    return model, processor
 
-        is_lora = os.path.isfile(os.path.join(model_path, "adapter_config.json"))
 
-        if is_lora:
-            print(">> Loading LoRA adapter:", model_path)
+def is_lora_adapter(model_path):
+    return os.path.isfile(os.path.join(model_path, "adapter_config.json"))
 
-            config = PeftConfig.from_pretrained(model_path)
+def snapshot_dir_for(model_path):
+    return os.path.join(SNAPSHOT_DIR, export_key(model_path, "snapshot")) if USE_SNAPSHOT else None
 
-            base_model_name = config.base_model_name_or_path
-            print(">> Base CLIP model:", base_model_name)
+def has_snapshot(model_path):
+    snapshot_dir = snapshot_dir_for(model_path)
+    return bool(snapshot_dir) and os.path.isfile(os.path.join(snapshot_dir, "model.safetensors"))
 
-            self.model = CLIPModel.from_pretrained(base_model_name)
 
-            self.model = PeftModel.from_pretrained(self.model, model_path)
+# Models loaded by preload(), keyed by model path.
+preloaded = {}
 
-            self.model = self.model.merge_and_unload()
+def preload(model_path=MODEL_PATH):
+    """Load the weights in the gunicorn master before workers fork, so all workers share one copy.
 
-            self.processor = CLIPProcessor.from_pretrained(base_model_name)
-        else:
-            print(">> Loading base CLIP model:", model_path)
-            self.model = CLIPModel.from_pretrained(model_path)
-            self.processor = CLIPProcessor.from_pretrained(model_path, use_fast=True)
+    Forked workers see the tensors copy-on-write and inference never writes to them,
+    so the pages stay shared. Backends, thread pools and warm-up are set up per worker.
+    """
+    if is_lora_adapter(model_path) and not has_snapshot(model_path):
+        # Merging the adapter runs torch compute, which must not happen in the process
+        # that forks the workers, so a short-lived child merges it and saves the snapshot.
+        if USE_SNAPSHOT:
+            builder = multiprocessing.get_context("fork").Process(target=load_clip, args=(model_path,), name="snapshot-builder")
+            builder.start()
+            builder.join()
+        if not has_snapshot(model_path):
+            print(">> No model snapshot to preload; each worker loads the model itself.")
+            return
+
+    preloaded[model_path] = load_clip(model_path)
+
+
+def save_snapshot(model, processor, snapshot_dir):
+    tmp_dir = f"{snapshot_dir}.{os.getpid()}.tmp"
+    try:
+        model.save_pretrained(tmp_dir, safe_serialization=True)
+        processor.save_pretrained(tmp_dir)
+        os.rename(tmp_dir, snapshot_dir)
+        print(">> Saved model snapshot:", snapshot_dir)
+    except OSError as e:
+        # Another process saved it first, or the cache volume is read-only; either way this boot is fine.
+        print(">> Could not save model snapshot:", e)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class ClipModel:
+    def __init__(self, model_path=MODEL_PATH, backend=CLIP_BACKEND):
+        # self.model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
+        # self.processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32", use_fast=True)
+        # self.model = CLIPModel.from_pretrained(model_path)
+        # self.processor = CLIPProcessor.from_pretrained(model_path, use_fast=True)
+
+        # Non-eager backends give slightly different embeddings, so they count as a different model.
+        self.model_id = model_path if backend == "eager" else f"{model_path}#{backend}"
+        self.text_cache = TextEmbeddingCache()
+
+        self.model, self.processor = preloaded.get(model_path) or load_clip(model_path)
+        self.preprocessor = ImagePreprocessor(self.processor.image_processor) if FAST_PREPROCESS else None
+
+        self.backend = load_backend(self.model, model_path, backend)
+        print(">> Inference backend:", self.backend.name)
 
     
     # def get_image_embedding(self, image):
@@ -69,13 +205,34 @@ class ClipModel:
     
     def get_image_embedding(self, image):
         device = next(self.model.parameters()).device
-        inputs = self.processor(images=image, return_tensors="pt").to(device)
-        with torch.no_grad():
-            emb = self.model.get_image_features(**inputs)
+        emb = self.backend.image_features(self.pixel_values([image]).to(device))
         return emb / emb.norm(dim=-1, keepdim=True)
+
+    def pixel_values(self, images):
+        if self.preprocessor is not None:
+            return self.preprocessor(images)
+        return self.processor(images=images, return_tensors="pt")["pixel_values"]
+
+    def get_image_embeddings(self, images, batch_size=IMAGE_BATCH_SIZE):
+        # Preprocess every image as one batch, then run the vision
+        # tower in micro-batches so peak memory stays bounded on CPU.
+        if not images:
+            return torch.empty(0, self.model.config.projection_dim)
+
+        device = next(self.model.parameters()).device
+        pixel_values = self.pixel_values(images)
+
+        embeddings = []
+        for chunk in batch(pixel_values, batch_size):
+            emb = self.backend.image_features(chunk.to(device))
+            embeddings.append(emb / emb.norm(dim=-1, keepdim=True))
+
+        return torch.cat(embeddings).cpu()
     
 
     def compute_image_embeddings(self, image_folder, output_file="clip/embeddings.pkl"):
+        import pickle
+
         embeddings = []
         image_files = []
 
@@ -103,15 +260,35 @@ class ClipModel:
         return embeddings, image_files
 
     def load_embeddings(self, path="clip/embeddings.pkl"):
+        import pickle
+
         with open(path, "rb") as f:
             image_embeddings, image_files = pickle.load(f)
 
         return image_embeddings, image_files
 
+    def warm_up(self):
+        """Run each tower once, so one-time initialisation is paid before the service reports ready."""
+        self.get_image_embeddings([Image.new("RGB", (224, 224))])
+        inputs = self.processor(text=["warm up"], return_tensors="pt", **self.backend.text_padding)
+        self.backend.text_features(inputs["input_ids"], inputs["attention_mask"])
+
     def compute_text_embedding(self, text):
-        inputs = self.processor(text=[text], return_tensors="pt")
-        with torch.no_grad():
-            text_emb = self.model.get_text_features(**inputs)
+        return self.compute_text_embeddings([text])
+
+    def compute_text_embeddings(self, texts):
+        keys = [(self.model_id, normalize_query(text)) for text in texts]
+        embeddings = [self.text_cache.get(key) for key in keys]
+
+        missing = list(dict.fromkeys(key for key, emb in zip(keys, embeddings) if emb is None))
+        if missing:
+            inputs = self.processor(text=[key[1] for key in missing], return_tensors="pt", **self.backend.text_padding)
+            text_embs = self.backend.text_features(inputs["input_ids"], inputs["attention_mask"])
+            text_embs = text_embs / text_embs.norm(dim=-1, keepdim=True)
 
-        return text_emb / text_emb.norm()
+            new_embs = {key: emb.clone() for key, emb in zip(missing, text_embs)}
+            for key, emb in new_embs.items():
+                self.text_cache.put(key, emb)
+            embeddings = [new_embs.get(key, emb) for key, emb in zip(keys, embeddings)]
 
+        return torch.stack(embeddings)
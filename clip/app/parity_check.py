@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+import torch
+from model import ClipModel
+from image_io import load_image
+
+# Compares the embeddings of each inference backend against the eager model, on the bundled
+# resources/ images. Preprocessing parity with the HF processor is covered by test_preprocess.py.
+# Usage: python parity_check.py [backend ...]   (default: int8 torchscript onnx)
+
+RESOURCES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "resources")
+MODEL_PATH = os.getenv("CLIP_MODEL_PATH", "openai/clip-vit-base-patch32")
+QUERIES = ["a cat", "a dog", "a puppy lying on the grass", "a city skyline at night"]
+# Below this cosine similarity to the eager embedding a backend is reported as failing.
+MIN_COSINE = 0.99
+
+backends = sys.argv[1:] or ["int8", "torchscript", "onnx"]
+
+image_files = sorted(
+    fname for fname in os.listdir(RESOURCES)
+    if fname.lower().endswith((".jpg", ".jpeg", ".png"))
+)
+images = [load_image(os.path.join(RESOURCES, fname)) for fname in image_files]
+
+
+def embed(clip_model):
+    # Measure real text forward passes rather than cache hits.
+    clip_model.text_cache.max_size = 0
+    start = time.perf_counter()
+    image_embs = clip_model.get_image_embeddings(images)
+    image_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    text_embs = clip_model.compute_text_embeddings(QUERIES)
+    text_time = time.perf_counter() - start
+    return image_embs, text_embs, image_time, text_time
+
+
+def ranking(image_embs, text_embs):
+    return (text_embs @ image_embs.T).argsort(dim=-1, descending=True)
+
+
+reference = ClipModel(MODEL_PATH, backend="eager")
+failed = False
+
+ref_images, ref_texts, ref_image_time, ref_text_time = embed(reference)
+ref_ranking = ranking(ref_images, ref_texts)
+print(f"eager: {len(images)} images in {ref_image_time * 1000:.1f} ms, {len(QUERIES)} texts in {ref_text_time * 1000:.1f} ms")
+
+for backend in backends:
+    clip_model = ClipModel(MODEL_PATH, backend=backend)
+    embed(clip_model)  # warm-up; the first pass of exported graphs includes optimisation
+    image_embs, text_embs, image_time, text_time = embed(clip_model)
+
+    image_cos = torch.nn.functional.cosine_similarity(image_embs, ref_images, dim=-1)
+    text_cos = torch.nn.functional.cosine_similarity(text_embs, ref_texts, dim=-1)
+    same_top1 = (ranking(image_embs, text_embs)[:, 0] == ref_ranking[:, 0]).float().mean().item()
+    ok = image_cos.min().item() >= MIN_COSINE and text_cos.min().item() >= MIN_COSINE
+    failed = failed or not ok
+
+    print(
+        f"{backend}: {'OK' if ok else 'FAIL'} | "
+        f"image cosine min {image_cos.min().item():.5f} mean {image_cos.mean().item():.5f} | "
+        f"text cosine min {text_cos.min().item():.5f} | "
+        f"top-1 agreement {same_top1:.0%} | "
+        f"images {image_time * 1000:.1f} ms ({ref_image_time / image_time:.2f}x), "
+        f"texts {text_time * 1000:.1f} ms ({ref_text_time / text_time:.2f}x)"
+    )
+
+sys.exit(1 if failed else 0)
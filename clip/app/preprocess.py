@@ -0,0 +1,53 @@
+import os
+import numpy as np
+import torch
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+
+PREPROCESS_WORKERS = int(os.getenv("CLIP_PREPROCESS_WORKERS", os.cpu_count() or 4))
+
+
+class ImagePreprocessor:
+    """Batch replacement for CLIPProcessor(images=...).
+
+    Resize and center crop run per image in a thread pool (PIL releases the GIL
+    while resampling), then the whole batch is rescaled and normalized as one
+    tensor. JPEGs already arrive decoded at reduced scale, see image_io.decode_image.
+    Settings are read from the model's own image processor, so the output matches
+    it up to float rounding; test_preprocess.py checks this.
+    """
+
+    def __init__(self, image_processor, workers=PREPROCESS_WORKERS):
+        self.shortest_edge = image_processor.size["shortest_edge"]
+        self.crop_height = image_processor.crop_size["height"]
+        self.crop_width = image_processor.crop_size["width"]
+        self.resample = Image.Resampling(int(image_processor.resample))
+        # Rescaling by 1/255 is folded into the normalization constants.
+        mean = torch.tensor(image_processor.image_mean, dtype=torch.float32).view(1, 3, 1, 1)
+        std = torch.tensor(image_processor.image_std, dtype=torch.float32).view(1, 3, 1, 1)
+        self.offset = mean * 255
+        self.scale = std * 255
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="preprocess")
+
+    def resized_size(self, width, height):
+        # Same rounding as transformers' get_resize_output_image_size: the short side
+        # becomes shortest_edge and the long side is scaled and truncated.
+        if width <= height:
+            return self.shortest_edge, int(self.shortest_edge * height / width)
+        return int(self.shortest_edge * width / height), self.shortest_edge
+
+    def prepare(self, image):
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        width, height = self.resized_size(*image.size)
+        image = image.resize((width, height), self.resample)
+
+        top = (height - self.crop_height) // 2
+        left = (width - self.crop_width) // 2
+        image = image.crop((left, top, left + self.crop_width, top + self.crop_height))
+        return np.asarray(image)
+
+    def __call__(self, images):
+        arrays = list(self._executor.map(self.prepare, images))
+        pixel_values = torch.from_numpy(np.stack(arrays)).permute(0, 3, 1, 2).float()
+        return pixel_values.sub_(self.offset).div_(self.scale)
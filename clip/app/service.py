@@ -1,30 +1,68 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Form, File, UploadFile
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from typing import List
+from typing import List, Dict
 import torch
-from PIL import Image
 import os
-import io
-import base64
-import requests
+import json
+import httpx
 from model import ClipModel
 import logging
-from ranking import rank_images
-from cache import get_or_create_embedding
+import threading
+from cache import HASH_ALGORITHM, get_or_create_embeddings, get_or_create_embeddings_async, get_or_create_embeddings_by_keys, get_missing_keys, rebuild_index
+from executors import run_blocking
+from batcher import BatchedClipModel
 from db_connector import init_db
+from vector_index import vector_index
 import time
 
 
-os.makedirs("/app/cache", exist_ok=True)
-init_db()
-print("Embedding cache initialized..")
+CLIP_BATCHING = os.getenv("CLIP_BATCHING", "true") == "true"
 
 app = FastAPI()
+http_client = httpx.AsyncClient(follow_redirects=True)
 
+# The model loads in the background so the process answers health checks right away;
+# endpoints that need it return 503 until /ready does.
+clip_model = None
+model_ready = threading.Event()
+model_error = None
 
+def load_model():
+    global clip_model, model_error
+    try:
+        start = time.time()
+        model = ClipModel()
+        model.warm_up()
+        if CLIP_BATCHING:
+            # Concurrent requests share forward passes instead of each running its own small one.
+            model = BatchedClipModel(model)
+        clip_model = model
+        model_ready.set()
+        logging.info(f"CLIP model loaded and warmed up in {time.time() - start:.1f}s.")
+    except Exception as e:
+        model_error = str(e)
+        logging.exception("Loading the CLIP model failed")
+
+# Everything that opens files or starts threads happens per process at startup, so the
+# module can be imported by the gunicorn master before it forks workers (see gunicorn.conf.py).
+@app.on_event("startup")
+def start_up():
+    os.makedirs("/app/cache", exist_ok=True)
+    init_db()
+    print("Embedding cache initialized..")
+    vector_index.load()
 
-clip_model = ClipModel()
-logging.info("CLIP model loaded successfully.")
+    threading.Thread(target=load_model, name="model-loader", daemon=True).start()
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await http_client.aclose()
+
+def require_model():
+    if not model_ready.is_set():
+        raise HTTPException(status_code=503, detail=model_error or "Model is still loading")
+    return clip_model
 
 class SimilarityRequest(BaseModel):
     images: List[str]
@@ -34,55 +72,159 @@ class SimilarityRequest(BaseModel):
 class SimilarityResponse(BaseModel):
     indices: List[int]
     scores: List[float]
+    # Images that could not be read or decoded, by index in the request; they are never ranked.
+    errors: Dict[int, str] = {}
 
-def load_image(image_source:str):
-    if os.path.exists(image_source):
-        return Image.open(image_source).convert("RGB")
-    
-    if image_source.startswith("http"):
-        try:
-            response = requests.get(image_source, timeout=10)
-            response.raise_for_status()
-            return Image.open(io.BytesIO(response.content)).convert("RGB")
-        except Exception as e:
-            raise ValueError(f"Error occured during download of image from URL {image_source}: {e}")
+class IndexSearchRequest(BaseModel):
+    query: str
+    top_k: int = 30
+    exclude_prefixes: List[str] = []
+
+class IndexSearchResponse(BaseModel):
+    sources: List[str]
+    scores: List[float]
+
+class IndexSourcesRequest(BaseModel):
+    sources: List[str]
+
+class IndexRebuildRequest(BaseModel):
+    exclude_prefixes: List[str] = []
+
+class KnownKeysRequest(BaseModel):
+    keys: List[str]
+
+class KnownKeysResponse(BaseModel):
+    missing: List[str]
+
+def rank_embeddings(img_embs, query, top_k, errors=None):
+    errors = errors or {}
+    if errors:
+        logging.warning(f"{len(errors)} of {len(img_embs)} images failed to load: {errors}")
+    if len(errors) == len(img_embs):
+        return SimilarityResponse(indices=[], scores=[], errors=errors)
+
+    text_emb = clip_model.compute_text_embedding(query)
+
+    img_embs = img_embs / img_embs.norm(dim=-1, keepdim=True)
+    text_emb = text_emb / text_emb.norm()
+
+    similarities = (img_embs @ text_emb.T).squeeze(1)
+    if errors:
+        similarities[list(errors)] = float("-inf")
+    scores = similarities.tolist()
+
+    k = min(top_k, similarities.shape[0] - len(errors))
     
-    try:
-        image_bytes = base64.b64decode(image_source)
-        return Image.open(io.BytesIO(image_bytes)).convert("RGB")
-    except Exception as e:
-        raise ValueError(f"False image data: {e}")
-        
+    top_indices = torch.topk(similarities, k).indices.tolist()
+    top_scores = [scores[i] for i in top_indices]
+
+    return SimilarityResponse(indices=top_indices, scores=top_scores, errors=errors)
+
+def search_vectors(query, top_k, exclude_prefixes):
+    text_emb = clip_model.compute_text_embedding(query)
+    return vector_index.search(text_emb.squeeze(0).numpy(), top_k, exclude_prefixes)
+
 @app.get("/")
 def read_root():
     return {"Hello": "World"}
 
+@app.get("/ready")
+def read_ready():
+    if not model_ready.is_set():
+        return JSONResponse(status_code=503, content={"ready": False, "error": model_error})
+    return {"ready": True}
+
+@app.get("/version")
+def read_version():
+    # The backend only sends cache keys (binary mode) when it hashes images the same way.
+    return {"model": require_model().model_id, "hash": HASH_ALGORITHM}
+
+@app.get("/stats")
+def read_stats():
+    return {
+        "ready": model_ready.is_set(),
+        "text_cache": clip_model.text_cache.stats() if clip_model else None,
+        "vector_index": vector_index.stats(),
+        "batching": clip_model.stats() if CLIP_BATCHING and clip_model else None,
+    }
+
 @app.post("/similarity", response_model=SimilarityResponse)
 async def compute_similarity(req: SimilarityRequest):
+    require_model()
     try:
-        images = [load_image(img) for img in req.images]
-
-        if not images:
+        if not req.images:
             return SimilarityResponse(indices=[], scores=[])
         
-        text_emb = clip_model.compute_text_embedding(req.query)
         # start = time.time()
-        img_embs = torch.cat([get_or_create_embedding(img, clip_model) for img in images])
+        img_embs, errors = await get_or_create_embeddings_async(req.images, clip_model, http_client)
         # print("Cache hit:", time.time() - start)
         
-        img_embs = img_embs / img_embs.norm(dim=-1, keepdim=True)
-        text_emb = text_emb / text_emb.norm()
+        return await run_blocking(rank_embeddings, img_embs, req.query, req.top_k, errors)
 
-        similarities = (img_embs @ text_emb.T).squeeze(1)
-        scores = similarities.tolist()
+    except Exception as e:
+        logging.exception("Error during similarity computation")
+        raise HTTPException(status_code=500, detail=str(e))
 
-        k = min(req.top_k, similarities.shape[0])
-        
-        top_indices = torch.topk(similarities, k).indices.tolist()
-        top_scores = [scores[i] for i in top_indices]
+@app.post("/similarity/known", response_model=KnownKeysResponse)
+async def known_keys(req: KnownKeysRequest):
+    return KnownKeysResponse(missing=await run_blocking(get_missing_keys, req.keys))
 
-        return SimilarityResponse(indices=top_indices, scores=top_scores)
+@app.post("/similarity/upload", response_model=SimilarityResponse)
+async def compute_similarity_upload(
+    query: str = Form(...),
+    keys: str = Form(...),
+    top_k: int = Form(5),
+    images: List[UploadFile] = File(default=[]),
+):
+    """Binary transfer mode: `keys` lists one cache key per image, and only uncached images are uploaded, named by key."""
+    require_model()
+    try:
+        key_list = json.loads(keys)
+        if not key_list:
+            return SimilarityResponse(indices=[], scores=[])
+
+        uploads = {image.filename: await image.read() for image in images}
+        img_embs, errors = await run_blocking(get_or_create_embeddings_by_keys, key_list, uploads, clip_model)
+
+        return await run_blocking(rank_embeddings, img_embs, query, top_k, errors)
 
     except Exception as e:
         logging.exception("Error during similarity computation")
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/search", response_model=IndexSearchResponse)
+async def search_index(req: IndexSearchRequest):
+    """Top-k nearest indexed images for a text query, without re-embedding any image."""
+    require_model()
+    results = await run_blocking(search_vectors, req.query, req.top_k, req.exclude_prefixes)
+
+    return IndexSearchResponse(
+        sources=[source for source, _, _ in results],
+        scores=[score for _, _, score in results],
+    )
+
+@app.post("/index/rebuild")
+async def rebuild_vector_index(req: IndexRebuildRequest = IndexRebuildRequest()):
+    """Compact and re-partition the vector index; `exclude_prefixes` drops every source under them."""
+    removed = await run_blocking(rebuild_index, req.exclude_prefixes)
+    if removed is None:
+        raise HTTPException(status_code=409, detail="The index is already being rebuilt")
+    return {"removed": removed, "size": len(vector_index)}
+
+@app.post("/index/add")
+async def add_to_index(req: IndexSourcesRequest):
+    """Embed shared-volume images ahead of any search and add them to the vector index.
+
+    This is the only way into the index: images ranked by /similarity are cached but not
+    indexed, so provider downloads never grow it and it holds only the local library.
+    """
+    require_model()
+    sources = [source for source in req.sources if os.path.isfile(source)]
+    errors = {}
+    if sources:
+        _, errors = await run_blocking(get_or_create_embeddings, sources, clip_model, True)
+    return {"indexed": len(sources) - len(errors), "missing": len(req.sources) - len(sources), "failed": len(errors)}
+
+@app.post("/index/remove")
+async def remove_from_index(req: IndexSourcesRequest):
+    return {"removed": await run_blocking(vector_index.remove, req.sources)}
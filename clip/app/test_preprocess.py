@@ -0,0 +1,53 @@
+import unittest
+import numpy as np
+import torch
+from PIL import Image
+from transformers import CLIPImageProcessor
+from preprocess import ImagePreprocessor
+
+# Both resize with PIL, so only float rounding in the normalization differs.
+TOLERANCE = 1e-4
+
+
+def random_image(width, height, mode="RGB"):
+    rng = np.random.default_rng(width * height)
+    pixels = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    return Image.fromarray(pixels).convert(mode)
+
+
+class ImagePreprocessorTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # The defaults are the settings CLIP checkpoints ship with, so no weights are needed.
+        cls.processor = CLIPImageProcessor()
+        cls.preprocessor = ImagePreprocessor(cls.processor, workers=2)
+
+    def assertMatchesProcessor(self, images):
+        expected = self.processor(images=images, return_tensors="pt")["pixel_values"]
+        actual = self.preprocessor(images)
+
+        self.assertEqual(actual.shape, expected.shape)
+        self.assertEqual(actual.dtype, torch.float32)
+        torch.testing.assert_close(actual, expected, atol=TOLERANCE, rtol=0)
+
+    def test_portrait(self):
+        self.assertMatchesProcessor([random_image(300, 517)])
+
+    def test_landscape(self):
+        self.assertMatchesProcessor([random_image(640, 427)])
+
+    def test_square(self):
+        self.assertMatchesProcessor([random_image(224, 224), random_image(500, 500)])
+
+    def test_smaller_than_crop(self):
+        self.assertMatchesProcessor([random_image(120, 90)])
+
+    def test_non_rgb(self):
+        self.assertMatchesProcessor([random_image(320, 240, "L"), random_image(240, 320, "RGBA"), random_image(256, 256, "P")])
+
+    def test_mixed_batch(self):
+        self.assertMatchesProcessor([random_image(300, 517), random_image(640, 427, "L"), random_image(224, 224)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,447 @@
+import os
+import fcntl
+import logging
+import sqlite3
+import threading
+import numpy as np
+from contextlib import contextmanager
+from utils import batch
+
+INDEX_DIR = os.getenv("CLIP_INDEX_DIR", "/app/cache/index")
+IVF_MIN_SIZE = int(os.getenv("CLIP_INDEX_IVF_MIN_SIZE", 4096))
+IVF_NPROBE = int(os.getenv("CLIP_INDEX_NPROBE", 8))
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_SIZE = 65536
+
+
+def _kmeans(vectors, n_lists, seed=0):
+    # Spherical k-means: vectors and centroids stay unit length, similarity is a dot product.
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        for list_id in range(n_lists):
+            members = vectors[assignments == list_id]
+            if len(members):
+                centroid = members.sum(axis=0)
+                centroids[list_id] = centroid / max(np.linalg.norm(centroid), 1e-12)
+    return centroids
+
+
+class VectorIndex:
+    """Persistent cosine-similarity index over image embeddings.
+
+    Vectors are appended to a raw float16 file that is memory-mapped for search, and
+    row metadata lives in SQLite, so adds and removes are incremental. Once the index
+    holds IVF_MIN_SIZE vectors it is partitioned with k-means and a search only scans
+    the IVF_NPROBE partitions closest to the query. Partitioning runs in the background
+    and only swapping the new partitions in holds the locks.
+
+    Several server processes can share one index directory: writes are serialized
+    with a file lock, every write bumps a generation counter, and each process
+    applies the rows changed since its own generation before it searches or writes.
+    """
+
+    def __init__(self, index_dir=INDEX_DIR, nprobe=IVF_NPROBE):
+        self.index_dir = index_dir
+        self.nprobe = nprobe
+        self.lock_path = os.path.join(index_dir, "write.lock")
+        self._lock = threading.RLock()
+        self._conn = None
+        self.generation = 0
+        # Bumped whenever existing rows change partition or are renumbered, so other
+        # processes reload instead of catching up.
+        self.layout = 0
+        # Compaction writes a new vectors file rather than rewriting the one others have mapped.
+        self.vectors_version = 0
+        self._training = False
+
+        self.dim = None
+        self.vectors = None
+        self.sources = []
+        self.keys = []
+        self.list_ids = []
+        self.live = {}
+        self.centroids = None
+        self.lists = {}
+        self.trained_size = 0
+
+    def load(self):
+        with self._lock:
+            os.makedirs(self.index_dir, exist_ok=True)
+            self._conn = sqlite3.connect(os.path.join(self.index_dir, "index.db"), check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    row INTEGER PRIMARY KEY,
+                    source TEXT,
+                    image_hash TEXT,
+                    list_id INTEGER,
+                    deleted INTEGER DEFAULT 0
+                )
+            """)
+            columns = [column[1] for column in self._conn.execute("PRAGMA table_info(entries)")]
+            if "version" not in columns:
+                # Generation of the last insert or delete of the row, so other processes can catch up on it.
+                self._conn.execute("ALTER TABLE entries ADD COLUMN version INTEGER DEFAULT 0")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_version ON entries (version)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+            self._conn.commit()
+
+            with self._file_lock():
+                self._load_state()
+                # Vectors are written before their rows are committed, so the file may run ahead after a crash.
+                if self.dim and os.path.exists(self.vectors_path):
+                    with open(self.vectors_path, "r+b") as f:
+                        f.truncate(len(self.sources) * self.dim * 2)
+            self._remap()
+            logging.info(f"Vector index loaded with {len(self.live)} vectors.")
+
+    def _load_state(self):
+        self.sources = []
+        self.keys = []
+        self.list_ids = []
+        self.live = {}
+        self.lists = {}
+        self.centroids = None
+
+        meta = dict(self._conn.execute("SELECT name, value FROM meta").fetchall())
+        self.dim = meta.get("dim")
+        self.trained_size = meta.get("trained_size", 0)
+        self.generation = meta.get("generation", 0)
+        self.layout = meta.get("layout", 0)
+        self.vectors_version = meta.get("vectors_version", 0)
+
+        self._apply(self._conn.execute("SELECT row, source, image_hash, list_id, deleted FROM entries ORDER BY row").fetchall())
+
+        if self.trained_size and os.path.exists(self._centroids_path(self.layout)):
+            self.centroids = np.load(self._centroids_path(self.layout))
+
+    def _centroids_path(self, layout):
+        # Versioned, so a crash between saving and committing never pairs centroids with the wrong lists.
+        return os.path.join(self.index_dir, "centroids.npy" if layout == 0 else f"centroids.{layout}.npy")
+
+    def _vectors_path(self, version):
+        return os.path.join(self.index_dir, "vectors.f16" if version == 0 else f"vectors.{version}.f16")
+
+    @property
+    def vectors_path(self):
+        return self._vectors_path(self.vectors_version)
+
+    def _apply(self, rows):
+        # Rows come in row order: new rows are appended, known rows can only have been deleted.
+        for row, source, image_hash, list_id, deleted in rows:
+            if row >= len(self.sources):
+                self.sources.append(source)
+                self.keys.append(image_hash)
+                self.list_ids.append(list_id)
+                if not deleted:
+                    self.live[source] = row
+                    self.lists.setdefault(list_id, []).append(row)
+            elif deleted and self.live.get(source) == row:
+                del self.live[source]
+                self.lists[self.list_ids[row]].remove(row)
+
+    def _sync(self):
+        """Catch up with writes made by other processes since this one last looked."""
+        meta = dict(self._conn.execute("SELECT name, value FROM meta").fetchall())
+        generation = meta.get("generation", 0)
+        if generation == self.generation:
+            return
+
+        if meta.get("layout", 0) != self.layout:
+            # Partitioning moved every row to a new list, so start over.
+            self._load_state()
+        else:
+            self.dim = meta.get("dim")
+            self._apply(self._conn.execute(
+                "SELECT row, source, image_hash, list_id, deleted FROM entries WHERE version > ? ORDER BY row",
+                (self.generation,),
+            ).fetchall())
+            self.generation = generation
+        self._remap()
+
+    @contextmanager
+    def _file_lock(self):
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    @contextmanager
+    def rebuild_lock(self):
+        """Non-blocking lock shared by all processes; yields whether this process got it."""
+        with open(os.path.join(self.index_dir, "rebuild.lock"), "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+
+    @contextmanager
+    def _writing(self):
+        # The process lock is taken first so threads of one process queue up before the file lock.
+        with self._lock, self._file_lock():
+            self._sync()
+            yield
+
+    def _bump(self):
+        # Only called inside _writing and a transaction, so this process holds the latest generation.
+        self.generation += 1
+        self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('generation', ?)", (self.generation,))
+        return self.generation
+
+    def __len__(self):
+        with self._lock:
+            self._sync()
+            return len(self.live)
+
+    def _remap(self):
+        if self.dim and self.sources:
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float16, mode="r", shape=(len(self.sources), self.dim))
+        else:
+            self.vectors = None
+
+    def _assign(self, vectors):
+        if self.centroids is None:
+            return np.zeros(len(vectors), dtype=np.int64)
+        return np.argmax(vectors @ self.centroids.T, axis=1)
+
+    def contains(self, source, image_hash):
+        with self._lock:
+            row = self.live.get(source)
+            return row is not None and self.keys[row] == image_hash
+
+    def add(self, sources, image_hashes, embeddings):
+        """Index (or re-index) each source with its embedding; unchanged entries are skipped."""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        with self._writing():
+            new = [
+                i for i, (source, image_hash) in enumerate(zip(sources, image_hashes))
+                if source and not self.contains(source, image_hash)
+            ]
+            new = list({sources[i]: i for i in new}.values())
+            if not new:
+                return
+
+            vectors = embeddings[new]
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('dim', ?)", (self.dim,))
+
+            stale = [self.live[sources[i]] for i in new if sources[i] in self.live]
+            list_ids = self._assign(vectors)
+            first_row = len(self.sources)
+
+            # Write at the first new row's offset rather than appending: a process that died
+            # between writing its vectors and committing their rows may have left bytes behind.
+            with open(self.vectors_path, "r+b" if os.path.exists(self.vectors_path) else "wb") as f:
+                f.seek(first_row * self.dim * 2)
+                f.write(vectors.astype(np.float16).tobytes())
+                f.truncate()
+
+            with self._conn:
+                generation = self._bump()
+                self._conn.executemany("UPDATE entries SET deleted = 1, version = ? WHERE row = ?", [(generation, row) for row in stale])
+                self._conn.executemany(
+                    "INSERT INTO entries (row, source, image_hash, list_id, version) VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (first_row + n, sources[i], image_hashes[i], int(list_ids[n]), generation)
+                        for n, i in enumerate(new)
+                    ],
+                )
+
+            for row in stale:
+                self.lists[self.list_ids[row]].remove(row)
+            for n, i in enumerate(new):
+                row = first_row + n
+                self.sources.append(sources[i])
+                self.keys.append(image_hashes[i])
+                self.list_ids.append(int(list_ids[n]))
+                self.live[sources[i]] = row
+                self.lists.setdefault(int(list_ids[n]), []).append(row)
+
+            self._remap()
+            self._maybe_train()
+
+    def remove(self, sources):
+        with self._writing():
+            rows = [self.live.pop(source) for source in sources if source in self.live]
+            if not rows:
+                return 0
+            with self._conn:
+                generation = self._bump()
+                self._conn.executemany("UPDATE entries SET deleted = 1, version = ? WHERE row = ?", [(generation, row) for row in rows])
+            for row in rows:
+                self.lists[self.list_ids[row]].remove(row)
+            return len(rows)
+
+    def _maybe_train(self):
+        if self._training or len(self.live) < IVF_MIN_SIZE or len(self.live) < 2 * self.trained_size:
+            return
+        self._training = True
+        threading.Thread(target=self._train_in_background, name="index-train", daemon=True).start()
+
+    def _train_in_background(self):
+        try:
+            self.train()
+        except Exception:
+            logging.exception("Partitioning the vector index failed")
+        finally:
+            self._training = False
+
+    def train(self):
+        """Partition the live vectors with k-means.
+
+        Clustering and assignment run on a snapshot without holding any lock; rows added
+        meanwhile are assigned when the new partitions are swapped in. If another process
+        re-partitioned in the meantime, this result is dropped.
+        """
+        with self._lock:
+            self._sync()
+            layout = self.layout
+            vectors = self.vectors
+            rows = np.fromiter(self.live.values(), dtype=np.int64)
+        if not len(rows):
+            return
+
+        n_lists = max(1, int(np.sqrt(len(rows))))
+        sample = rows if len(rows) <= KMEANS_SAMPLE_SIZE else np.random.default_rng(0).choice(rows, KMEANS_SAMPLE_SIZE, replace=False)
+        centroids = _kmeans(vectors[np.sort(sample)].astype(np.float32), n_lists)
+        list_ids = np.concatenate([
+            np.argmax(vectors[chunk].astype(np.float32) @ centroids.T, axis=1)
+            for chunk in batch(np.sort(rows), 8192)
+        ])
+        assigned = dict(zip(np.sort(rows).tolist(), list_ids.tolist()))
+
+        with self._writing():
+            if self.layout != layout:
+                return
+            live_rows = sorted(self.live.values())
+            added = [row for row in live_rows if row not in assigned]
+            if added:
+                assigned.update(zip(added, np.argmax(self.vectors[added].astype(np.float32) @ centroids.T, axis=1).tolist()))
+
+            new_layout = layout + 1
+            tmp_path = self._centroids_path(new_layout) + ".tmp.npy"
+            np.save(tmp_path, centroids)
+            os.replace(tmp_path, self._centroids_path(new_layout))
+            with self._conn:
+                self._conn.executemany("UPDATE entries SET list_id = ? WHERE row = ?", [(assigned[row], row) for row in live_rows])
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+                    [("trained_size", len(live_rows)), ("layout", new_layout)],
+                )
+                self._bump()
+
+            old_centroids = self._centroids_path(layout)
+            self.layout = new_layout
+            self.trained_size = len(live_rows)
+            self.centroids = centroids
+            self.lists = {}
+            for row in live_rows:
+                self.list_ids[row] = assigned[row]
+                self.lists.setdefault(assigned[row], []).append(row)
+            if os.path.exists(old_centroids):
+                os.remove(old_centroids)
+        logging.info(f"Vector index partitioned into {n_lists} lists over {len(live_rows)} vectors.")
+
+    def compact(self, keep=os.path.isfile):
+        """Rewrite the index with only the live rows whose source keep() accepts.
+
+        Removed and dropped rows leave the vectors file and the rest are renumbered. The
+        result is written as a new layout, so processes still reading the old files are
+        not disturbed. Returns the number of rows removed from the file.
+        """
+        with self._writing():
+            kept = sorted(row for source, row in self.live.items() if keep(source))
+            removed = len(self.sources) - len(kept)
+            if not removed:
+                return 0
+
+            layout = self.layout + 1
+            vectors_version = self.vectors_version + 1
+            with open(self._vectors_path(vectors_version), "wb") as f:
+                for chunk in batch(kept, 8192):
+                    f.write(np.asarray(self.vectors[chunk], dtype=np.float16).tobytes())
+            if self.centroids is not None:
+                np.save(self._centroids_path(layout), self.centroids)
+
+            with self._conn:
+                generation = self._bump()
+                self._conn.execute("DELETE FROM entries")
+                self._conn.executemany(
+                    "INSERT INTO entries (row, source, image_hash, list_id, version) VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (n, self.sources[row], self.keys[row], self.list_ids[row], generation)
+                        for n, row in enumerate(kept)
+                    ],
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+                    [("layout", layout), ("vectors_version", vectors_version)],
+                )
+
+            old_files = [self.vectors_path, self._centroids_path(self.layout)]
+            self._load_state()
+            self._remap()
+            for path in old_files:
+                if os.path.exists(path):
+                    os.remove(path)
+            logging.info(f"Vector index compacted: {removed} rows removed, {len(kept)} kept.")
+            return removed
+
+    def _candidates(self, query, top_k, exclude_prefixes):
+        """Rows to score: the nprobe closest lists, minus excluded sources.
+
+        Exclusion happens before scoring, and further lists are probed until top_k rows
+        are left, so excluded images crowding the nearest lists cannot starve the result.
+        """
+        if self.centroids is None:
+            order = list(self.lists)
+        else:
+            order = np.argsort(self.centroids @ query)[::-1].tolist()
+
+        rows = []
+        for probed, list_id in enumerate(order):
+            if probed >= self.nprobe and len(rows) >= top_k:
+                break
+            members = self.lists.get(list_id, [])
+            if exclude_prefixes:
+                members = [row for row in members if not self.sources[row].startswith(exclude_prefixes)]
+            rows.extend(members)
+        return rows
+
+    def search(self, query_embedding, top_k, exclude_prefixes=()):
+        """Return up to top_k (source, image_hash, score) tuples, best first."""
+        query = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        exclude_prefixes = tuple(exclude_prefixes)
+
+        with self._lock:
+            self._sync()
+            if self.vectors is None or not self.live:
+                return []
+
+            rows = np.array(self._candidates(query, top_k, exclude_prefixes), dtype=np.int64)
+            if not len(rows):
+                return []
+            rows.sort()
+            scores = self.vectors[rows].astype(np.float32) @ query
+
+            return [
+                (self.sources[rows[i]], self.keys[rows[i]], float(scores[i]))
+                for i in np.argsort(scores)[::-1][:top_k]
+            ]
+
+    def stats(self):
+        with self._lock:
+            self._sync()
+            return {
+                "size": len(self.live),
+                "rows": len(self.sources),
+                "lists": 0 if self.centroids is None else len(self.centroids),
+                "nprobe": self.nprobe,
+            }
+
+
+vector_index = VectorIndex()
@@ -82,6 +82,7 @@ function HomePage({ isLoggedIn }: HomePageProps) {
 
     setQuery("");
     setProgress({percent: 0, status: "started"});
+    setResults([]);
     setLoading(true);
     setSearched(true);
 
@@ -102,6 +103,11 @@ function HomePage({ isLoggedIn }: HomePageProps) {
         setProgress({percent:payload.percent, status: payload.tag})
       });
 
+      es.addEventListener("partial", (e) => {
+        const payload = JSON.parse(e.data)
+        setResults(payload.results)
+      });
+
       es.addEventListener("done", (e) => {
         const payload = JSON.parse(e.data)
         setResults(payload)